@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # translate raw events to names
 # event-translate rXXX ...
+# without arguments translate the raw events in perf report, script or
+# stat output from stdin to stdout
+# perf report --stdio | event-translate
 import re
 import sys
 import ocperf
@@ -9,6 +12,12 @@ from pmudef import *
 emap = ocperf.find_emap()
 if not emap:
     sys.exit("Unknown CPU or cannot find event table")
+if len(sys.argv) == 1:
+    try:
+        ocperf.RawTranslator(emap).filter(sys.stdin, sys.stdout)
+    except IOError:
+        pass
+    sys.exit(0)
 for j in sys.argv[1:]:
     m = re.match(r'r([0-9a-f]+)(:.*)?', j)
     if m:
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# generate a perf stat record file (pipe format) with constant counts
+# for testing toplev --import
+# gen-stat-record.py [--cpus 0,2,5] [--cpu-map cpus|mask|range] [--long-size 8] out events...
+import sys
+import struct
+import argparse
+import tl_statrecord as sr
+
+def record(typ, body):
+    body += "\0" * (-len(body) % 8)
+    return struct.pack("=IHH", typ, 0, 8 + len(body)) + body
+
+ATTR_SIZE = 120
+
+def cpu_map(kind, cpus, long_size):
+    if kind == "cpus":
+        return struct.pack("=HH%dH" % len(cpus), sr.CPU_MAP_CPUS, len(cpus), *cpus)
+    if kind == "range":
+        return struct.pack("=HBBHH", sr.CPU_MAP_RANGE, 0, 0, cpus[0], cpus[-1])
+    bits = long_size * 8
+    words = [0] * (max(cpus) / bits + 1)
+    for c in cpus:
+        words[c / bits] |= 1 << (c % bits)
+    fmt = "Q" if long_size == 8 else "I"
+    return (struct.pack("=HHH", sr.CPU_MAP_MASK, len(words), long_size) +
+            "\0" * (long_size - 4) +
+            struct.pack("=%d%s" % (len(words), fmt), *words))
+
+def main():
+    p = argparse.ArgumentParser(usage='generate a perf stat record file')
+    p.add_argument('--cpus', default="0,2,5", help='cpu list')
+    p.add_argument('--cpu-map', default="mask", choices=("cpus", "mask", "range"))
+    p.add_argument('--long-size', type=int, default=8, choices=(4, 8))
+    p.add_argument('--intervals', type=int, default=2)
+    p.add_argument('--interval', type=int, default=1000, help='interval in ms')
+    p.add_argument('out')
+    p.add_argument('events', nargs='+')
+    args = p.parse_args()
+    cpus = map(int, args.cpus.split(","))
+    if args.cpu_map == "range":
+        cpus = range(cpus[0], cpus[-1] + 1)
+    l = ["PERFILE2" + struct.pack("=Q", 16)]
+    for i, ev in enumerate(args.events):
+        attr = struct.pack("=IIQ", 4, ATTR_SIZE, i).ljust(ATTR_SIZE, "\0")
+        l.append(record(sr.HEADER_ATTR, attr + struct.pack("=Q", i + 1)))
+        l.append(record(sr.EVENT_UPDATE, struct.pack("=QQ", sr.EVENT_UPDATE_NAME, i + 1) + ev + "\0"))
+    l.append(record(sr.CPU_MAP, cpu_map(args.cpu_map, cpus, args.long_size)))
+    l.append(record(sr.STAT_CONFIG, struct.pack("=5Q", 2,
+        sr.STAT_CONFIG_AGGR_MODE, sr.AGGR_NONE, sr.STAT_CONFIG_INTERVAL, args.interval)))
+    for n in range(args.intervals):
+        for i in range(len(args.events)):
+            for c in range(len(cpus)):
+                l.append(record(sr.STAT, sr.stat_record.pack(i + 1, c, 0,
+                         1000000 * (i + 1), 1000000, 1000000)))
+        l.append(record(sr.STAT_ROUND, struct.pack("=QQ", sr.ROUND_INTERVAL,
+                        (n + 1) * args.interval * 1000000)))
+    with open(args.out, "wb") as f:
+        f.write("".join(l))
+
+if __name__ == '__main__':
+    main()
@@ -5,5 +5,5 @@ import sys
 emap = ocperf.find_emap()
 if not emap:
     sys.exit("Unknown CPU or cannot find event table")
-for j in sorted(emap.events):
+for j, desc in emap.event_names():
     print j
@@ -48,6 +48,7 @@
 # --print       only print
 # --force-download Force event list download
 # --experimental Support experimental events
+# list --search "words" list only events matching all words, best matches first
 import sys
 import os
 import subprocess
@@ -57,6 +58,11 @@ import copy
 import textwrap
 import pipes
 import itertools
+import heapq
+import bisect
+from collections import namedtuple
+import hashlib
+import cPickle
 from pmudef import *
 
 import msr as msrmod
@@ -446,6 +452,18 @@ fixed_counters = {
     "cpu_clk_unhalted.thread_any": (0x3c, 0, 1),
 }
 
+# weight of words in event names compared to descriptions for search
+NAME_WEIGHT = 3
+
+def tokenize(s):
+    return re.findall(r"[a-z0-9]+", s.lower())
+
+# result of EmapNativeJSON.resolve
+# event: the Event, config: the encoded event select value, extra: perf
+# qualifiers, msr/msrval: extra MSR to program, perf: perf event string
+Resolved = namedtuple("Resolved", ["name", "event", "config", "extra", "msr", "msrval",
+                                   "pebs", "period", "perf"])
+
 def update_ename(ev, name):
     if ev:
         ev = copy.deepcopy(ev)
@@ -463,7 +481,19 @@ class EmapNativeJSON(object):
         self.pevents = {}
         self.latego = False
         self.uncore_events = {}
+        # offcore matrix: the OFFCORE_RESPONSE event, and requests and
+        # responses name -> (value, description)
+        self.offcore = None
+        self.offcore_requests = {}
+        self.offcore_responses = {}
+        self.offcore_events = {}
+        self.resolved = {}
+        # search index: token -> {event name: weight}, built on first search
+        self.index = None
+        self.tokens = None
+        self.cache = None
         self.error = False
+        self.files = [] # all files read, to identify the event map
         self.read_events(name)
 
     def add_event(self, e):
@@ -571,18 +601,19 @@ class EmapNativeJSON(object):
             extra = m.group(2)
             edelim = ":"
             e = m.group(1)
-        if e in self.events:
+        ev = self.events.get(e)
+        if ev is None and e.startswith("offcore_response."):
+            ev = self.offcore_event(e)
+        if ev:
             # hack for now. Avoid ambiguity with :p
             # Should handle qualmap properly here
             extra = extra.replace("period=", "sample-after=")
             extra = extra_set(extra)
-            ev = self.events[e]
             ev_extra = extra_set(ev.extra)
             if extra and merge_extra(ev_extra, extra) > ev_extra:
-                ev = copy.deepcopy(self.events[e])
+                ev = copy.deepcopy(ev)
                 ev.extra = "".join(merge_extra(ev_extra, extra))
-                return ev
-            return self.events[e]
+            return ev
         elif e.endswith("_ps"):
             return update_ename(self.getevent(e[:-3] + ":p" + extra), e)
         elif e.endswith("_0") or e.endswith("_1"):
@@ -599,6 +630,79 @@ class EmapNativeJSON(object):
             return self.perf_events[e]
         return None
 
+    def split_offcore(self, e):
+        """Split offcore_response.REQUEST.RESPONSE into request and response."""
+        n = e[len("offcore_response."):]
+        for m in re.finditer(r"\.", n):
+            req, resp = n[:m.start()], n[m.end():]
+            if req in self.offcore_requests and resp in self.offcore_responses:
+                return req, resp
+        return None
+
+    def offcore_event(self, e):
+        """Return the offcore matrix event e (offcore_response.REQUEST.RESPONSE)
+           or None. Created when first used."""
+        if e in self.offcore_events:
+            return self.offcore_events[e]
+        if not self.offcore:
+            return None
+        r = self.split_offcore(e)
+        if r is None:
+            return None
+        req_val, req_desc = self.offcore_requests[r[0]]
+        res_val, res_desc = self.offcore_responses[r[1]]
+        oe = copy.deepcopy(self.offcore)
+        oe.name = e
+        oe.msrval = req_val | (res_val << 16)
+        oe.desc = req_desc + " " + res_desc
+        if version.offcore:
+            oe.newextra = ",offcore_rsp=0x%x" % (oe.msrval, )
+        else:
+            oe.msr = 0x1a6
+        self.offcore_events[e] = oe
+        return oe
+
+    def offcore_names(self):
+        """Generate the names and descriptions of all offcore matrix events
+           that are not normal events, sorted by name."""
+        if not self.offcore:
+            return
+        for req in sorted(self.offcore_requests.keys()):
+            for resp in sorted(self.offcore_responses.keys()):
+                name = "offcore_response.%s.%s" % (req, resp)
+                if name not in self.events:
+                    yield name, self.offcore_requests[req][1] + " " + self.offcore_responses[resp][1]
+
+    def event_names(self):
+        """Generate the names and descriptions of all core events, sorted by name."""
+        return heapq.merge(((k, self.desc[k]) for k in sorted(self.events.keys())),
+                           self.offcore_names())
+
+    def resolve_event(self, e):
+        """Resolve event name e into a Resolved tuple, or None when not found.
+           Results are cached by name. The perf string is added to the reverse map."""
+        if e in self.resolved:
+            return self.resolved[e]
+        ev = self.getevent(e)
+        r = None
+        if ev:
+            perf = ev.output(noname=True)
+            r = Resolved(e, ev, getattr(ev, 'val', None), ev.extra if hasattr(ev, 'extra') else "",
+                         ev.msr, ev.msrval if ev.msr else 0, getattr(ev, 'pebs', None),
+                         getattr(ev, 'period', 0), perf)
+            self.update_event(perf, ev)
+        self.resolved[e] = r
+        return r
+
+    def resolve(self, names):
+        """Resolve a list of event names. Return a list of Resolved tuples
+           (or None for unknown events)."""
+        return map(self.resolve_event, names)
+
+    def config_event(self, val):
+        """Return the core event with event select value val, or None."""
+        return self.codes.get(val)
+
     def update_event(self, e, ev):
         if e not in self.pevents:
             self.pevents[e] = ev
@@ -611,6 +715,9 @@ class EmapNativeJSON(object):
             if ev.extra:
                 s += ":" + ev.extra
             return s
+        ev = self.codes.get(r & EVMASK)
+        if ev:
+            return ev.name
         return "!Raw 0x%x" % (r,)
 
     def getperf(self, p):
@@ -625,10 +732,82 @@ class EmapNativeJSON(object):
         if human:
             wrap = textwrap.TextWrapper(initial_indent="     ",
                                         subsequent_indent="     ")            
-        for k in sorted(self.events.keys()):
-            print_event(k, self.desc[k], f, human, wrap)
+        for k, desc in self.all_events():
+            print_event(k, desc, f, human, wrap)
+
+    def dumpsearch(self, query, f=sys.stdout, human=True):
+        """Print the events matching query, best first."""
+        wrap = None
+        if human:
+            wrap = textwrap.TextWrapper(initial_indent="     ",
+                                        subsequent_indent="     ")
+        for k in self.search(query):
+            print_event(k, self.event_desc(k), f, human, wrap)
+
+    def save_cache(self):
+        """Write the event map to its compiled cache file."""
+        if not self.cache:
+            return
+        d = dict(self.__dict__)
+        d["resolved"] = {}
+        d["offcore_events"] = {}
+        tmp = "%s.%d" % (self.cache, os.getpid())
+        try:
+            with open(tmp, "wb") as f:
+                cPickle.dump(d, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.cache)
+        except (IOError, OSError):
+            pass
+
+    def all_events(self):
+        """Generate the names and descriptions of all core, offcore and uncore events."""
+        for k, desc in self.event_names():
+            yield k, desc
         for k in sorted(self.uncore_events.keys()):
-            print_event(k, self.uncore_events[k].desc, f, human, wrap)
+            yield k, self.uncore_events[k].desc
+
+    def build_index(self):
+        index = {}
+        for k, desc in self.all_events():
+            for w, l in ((NAME_WEIGHT, tokenize(k)), (1, tokenize(desc))):
+                for t in l:
+                    d = index.setdefault(t, {})
+                    d[k] = max(d.get(k, 0), w)
+        self.index = index
+        self.tokens = sorted(index.keys())
+        self.save_cache()
+
+    def search(self, query, limit=None):
+        """Search events matching all words in query in their name or description,
+           also as prefix. Return a list of names, best matches first.
+           The index is built on the first search and kept in the cache."""
+        if self.index is None:
+            self.build_index()
+        score = None
+        for q in tokenize(query):
+            found = {}
+            i = bisect.bisect_left(self.tokens, q)
+            while i < len(self.tokens) and self.tokens[i].startswith(q):
+                t = self.tokens[i]
+                w = 2 if t == q else 1
+                for k, v in self.index[t].iteritems():
+                    found[k] = max(found.get(k, 0), v * w)
+                i += 1
+            if score is None:
+                score = found
+            else:
+                score = dict([(k, v + found[k]) for k, v in score.iteritems() if k in found])
+        if not score:
+            return []
+        l = sorted(score.keys(), key=lambda k: (-score[k], k))
+        return l[:limit] if limit else l
+
+    def event_desc(self, e):
+        """Return the description of event e."""
+        if e in self.uncore_events:
+            return self.uncore_events[e].desc
+        ev = self.getevent(e)
+        return ev.desc if ev else ""
 
     def read_events(self, name):
         """Read JSON normal events table."""
@@ -652,6 +831,7 @@ class EmapNativeJSON(object):
         }
         if name.find("JKT") >= 0 or name.find("Jaketown") >= 0:
             self.latego = True
+        self.files.append(name)
         try:
             data = json.load(open(name, 'rb'))
         except ValueError as e:
@@ -665,6 +845,7 @@ class EmapNativeJSON(object):
     def add_offcore(self, name):
         """Read offcore table."""
         data = json.load(open(name, 'rb'))
+        self.files.append(name)
         #   {
         #    "MATRIX_REQUEST": "DEMAND_DATA_RD",
         #    "MATRIX_RESPONSE": "NULL",
@@ -676,33 +857,19 @@ class EmapNativeJSON(object):
         offcore_response = self.getevent("OFFCORE_RESPONSE")
         if not offcore_response:
             return
-        requests = []
-        responses = []
-
+        # the events are only created in offcore_event when used
+        self.offcore = offcore_response
         for row in data:
             if row[u"MATRIX_REQUEST"].upper() != "NULL":
-                requests.append((row[u"MATRIX_REQUEST"], row[u"MATRIX_VALUE"], row[u"DESCRIPTION"]))
+                self.offcore_requests[row[u"MATRIX_REQUEST"].lower()] = (
+                        int(row[u"MATRIX_VALUE"], 16), row[u"DESCRIPTION"])
             if row[u"MATRIX_RESPONSE"].upper() != "NULL":
-                responses.append((row[u"MATRIX_RESPONSE"], row[u"MATRIX_VALUE"], row[u"DESCRIPTION"]))
-
-        def create_event(req_name, req_val, req_desc, res_name, res_val, res_desc):
-            oe = copy.deepcopy(offcore_response)
-            oe.name = ("OFFCORE_RESPONSE.%s.%s" % (req_name, res_name)).lower()
-            if oe.name.lower() in self.events:
-                return
-            oe.msrval = int(req_val, 16) | (int(res_val, 16) << 16)
-            oe.desc = req_desc + " " + res_desc
-            if version.offcore:
-                oe.newextra = ",offcore_rsp=0x%x" % (oe.msrval, )
-            else:
-                oe.msr = 0x1a6
-            self.add_event(oe)
-
-        for a, b in itertools.product(requests, responses):
-            create_event(*(a + b))
+                self.offcore_responses[row[u"MATRIX_RESPONSE"].lower()] = (
+                        int(row[u"MATRIX_VALUE"], 16), row[u"DESCRIPTION"])
 
     def add_uncore(self, name, force=False):
         data = json.load(open(name, "rb"))
+        self.files.append(name)
         for row in data:
             name = row['EventName'].lower()
             try:
@@ -710,68 +877,105 @@ class EmapNativeJSON(object):
             except UnicodeEncodeError:
                 pass
 
+# bump when the EmapNativeJSON data changes
+EMAP_CACHE_VERSION = 5
+
+# the cache pickles the event classes as ocperf.*, also when run as a script
+Event.__module__ = UncoreEvent.__module__ = "ocperf"
+if __name__ == '__main__':
+    sys.modules["ocperf"] = sys.modules[__name__]
+
+def emap_cache_name(files):
+    """Return the name of the compiled cache file for the event files
+       (a list of (method, filename)), or None."""
+    key = [EMAP_CACHE_VERSION, version.offcore, version.ldlat, pebs_enable]
+    try:
+        for method, fn in files:
+            st = os.stat(fn)
+            key.append((method, os.path.abspath(fn), st.st_mtime, st.st_size))
+        return "%s/emap-%s.pickle" % (event_download.getdir(),
+                hashlib.sha1(repr(key)).hexdigest())
+    except Exception:
+        return None
+
+def load_emap(files):
+    """Read the event files (a list of (method, filename)). The first is the core
+       event file. Use the compiled cache when it is up to date."""
+    cache = emap_cache_name(files) if not force_download else None
+    if cache:
+        try:
+            with open(cache, "rb") as f:
+                emap = EmapNativeJSON.__new__(EmapNativeJSON)
+                emap.__dict__ = cPickle.load(f)
+                return emap
+        except (IOError, EOFError, cPickle.UnpicklingError, AttributeError, ImportError):
+            pass
+    emap = EmapNativeJSON(files[0][1])
+    if emap.error:
+        return emap
+    for method, fn in files[1:]:
+        try:
+            getattr(emap, method)(fn)
+        except IOError:
+            print >>sys.stderr, "Cannot open", fn
+    emap.cache = cache
+    emap.save_cache()
+    return emap
+
 def json_with_extra(el):
-    emap = EmapNativeJSON(event_download.eventlist_name(el, "core"))
+    name = event_download.eventlist_name(el, "core")
+    files = [("read_events", name)]
+    if experimental:
+        fn = event_download.eventlist_name(el, "core experimental")
+        if os.path.exists(fn):
+            files.append(("read_events", fn))
+    emap = load_emap(files + extra_files(el))
     if not emap or emap.error:
         print >>sys.stderr, "parsing", name, "failed"
         return None
-    if not emap or emap.error:
-	print >>sys.stderr, "parsing", name, "failed"
-	return None
-    if experimental:
-	try:
-	    emap.read_events(event_download.eventlist_name(el, "core experimental"))
-	except IOError:
-	    pass
-    add_extra_env(emap, el)
     return emap
 
-def add_extra_env(emap, el):
-    try:
-        oc = os.getenv("OFFCORE")
-        if oc:
-            oc = canon_emapvar(oc, "matrix")
-            emap.add_offcore(oc)
-        else:
-            oc = event_download.eventlist_name(el, "offcore")
+def extra_files(el):
+    """Return the extra event files for el, specified by the OFFCORE, UNCORE,
+       EVENTMAP2 and UNCORE2 environment variables or next to el, as
+       a list of (EmapNativeJSON method, filename)."""
+    files = []
+    oc = os.getenv("OFFCORE")
+    if oc:
+        files.append(("add_offcore", canon_emapvar(oc, "matrix")))
+    else:
+        oc = event_download.eventlist_name(el, "offcore")
+        if os.path.exists(oc):
+            files.append(("add_offcore", oc))
+        if experimental:
+            oc = event_download.eventlist_name(el, "offcore experimental")
             if os.path.exists(oc):
-                emap.add_offcore(oc)
-	    if experimental:
-		oc = event_download.eventlist_name(el, "offcore experimental")
-		if os.path.exists(oc):
-		    emap.add_offcore(oc)
-    except IOError:
-        print >>sys.stderr, "Cannot open", oc
-    try:
-        uc = os.getenv("UNCORE")
-        if uc:
-            uc = canon_emapvar(uc, "uncore")
-            emap.add_uncore(uc)
-        else:
-            uc = event_download.eventlist_name(el, "uncore")
+                files.append(("add_offcore", oc))
+    uc = os.getenv("UNCORE")
+    if uc:
+        files.append(("add_uncore", canon_emapvar(uc, "uncore")))
+    else:
+        uc = event_download.eventlist_name(el, "uncore")
+        if os.path.exists(uc):
+            files.append(("add_uncore", uc))
+        if experimental:
+            uc = event_download.eventlist_name(el, "uncore experimental")
             if os.path.exists(uc):
-                emap.add_uncore(uc)
-	    if experimental:
-		uc = event_download.eventlist_name(el, "uncore experimental")
-		if os.path.exists(uc):
-		    emap.add_uncore(uc)
-    except IOError:
-        print >>sys.stderr, "Cannot open", uc
-    try:
-        e2 = os.getenv("EVENTMAP2")
-        if e2:
-            e2 = canon_emapvar(e2, "core")
-            emap.read_events(e2)
-            # don't try to download for now
-    except IOError:
-        print >>sys.stderr, "Cannot open", e2
-    try:
-        u2 = os.getenv("UNCORE2")
-        if u2:
-            u2 = canon_emapvar(u2, "uncore")
-            emap.add_uncore(u2, True)
-    except IOError:
-        print >>sys.stderr, "Cannot open", u2
+                files.append(("add_uncore", uc))
+    e2 = os.getenv("EVENTMAP2")
+    if e2:
+        files.append(("read_events", canon_emapvar(e2, "core")))
+    u2 = os.getenv("UNCORE2")
+    if u2:
+        files.append(("add_uncore", canon_emapvar(u2, "uncore")))
+    return files
+
+def add_extra_env(emap, el):
+    for method, fn in extra_files(el):
+        try:
+            getattr(emap, method)(fn)
+        except IOError:
+            print >>sys.stderr, "Cannot open", fn
     return emap
 
 def canon_emapvar(el, typ):
@@ -801,10 +1005,9 @@ def find_emap():
     el = canon_emapvar(el, "core")
     if "/" in el:
         try:
-            emap = EmapNativeJSON(el)
+            emap = load_emap([("read_events", el)] + extra_files(el))
             if not emap or emap.error:
                 return None
-            add_extra_env(emap, el)
             return emap
         except IOError:
             return None
@@ -957,6 +1160,51 @@ def get_pager():
             f = sys.stdout
     return f, None
 
+# raw events and cpu/.../ events in perf report or stat output
+raw_output_re = re.compile(r"[rR]aw 0x([0-9a-f]{4,})|r([0-9a-f]{4,})|(cpu/.*?/)")
+
+TRANSLATE_BUFSIZE = 1024 * 1024
+
+class RawTranslator:
+    """Translate raw events in perf output to event names.
+       The names of every raw string are only looked up once."""
+    def __init__(self, emap):
+        self.emap = emap
+        self.names = {}
+
+    def name(self, m):
+        s = m.group(0)
+        n = self.names.get(s)
+        if n is None:
+            if m.group(3):
+                n = self.emap.getperf(m.group(3))
+            else:
+                n = " " + self.emap.getraw(int(m.group(1) or m.group(2), 16))
+            self.names[s] = n
+        return n
+
+    def translate(self, s):
+        return raw_output_re.sub(self.name, s)
+
+    def filter(self, inf, outf, bufsize=TRANSLATE_BUFSIZE):
+        """Copy inf to outf translating raw events. Reads whatever is
+           available up to bufsize, so that pipes are not delayed."""
+        fd = inf.fileno()
+        rest = ""
+        while True:
+            buf = os.read(fd, bufsize)
+            if not buf:
+                break
+            buf = rest + buf
+            n = buf.rfind("\n") + 1
+            rest = buf[n:]
+            if n > 0:
+                outf.write(self.translate(buf[:n]))
+                outf.flush()
+        if rest:
+            outf.write(self.translate(rest))
+            outf.flush()
+
 def perf_cmd(cmd):
     if emap is None:
         sys.exit(subprocess.call(cmd))
@@ -987,12 +1235,7 @@ def perf_cmd(cmd):
             pipe = subprocess.Popen(cmd,
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.STDOUT).stdout
-            raw = lambda e: " " + emap.getraw(int(e.group(1), 16))
-            for i in pipe:
-                i = re.sub("[rR]aw 0x([0-9a-f]{4,})", raw, i)
-                i = re.sub("r([0-9a-f]{4,})", raw, i)
-                i = re.sub("(cpu/.*?/)", lambda e: emap.getperf(e.group(1)), i)
-                print i,
+            RawTranslator(emap).filter(pipe, sys.stdout)
         except IOError:
             pass
         pipe.close()
@@ -1009,6 +1252,12 @@ if __name__ == '__main__':
     emap = find_emap()
     if not emap:
         print >>sys.stderr, "Do not recognize CPU or cannot find CPU map file."
+    if emap and sys.argv[1:2] == ["list"] and "--search" in sys.argv:
+        i = sys.argv.index("--search")
+        if i + 1 >= len(sys.argv):
+            sys.exit("--search needs an argument")
+        emap.dumpsearch(sys.argv[i + 1], sys.stdout, sys.stdout.isatty())
+        sys.exit(0)
     msr = MSR()
     cmd = process_args()
     try:
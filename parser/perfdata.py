@@ -194,7 +194,13 @@ def perf_event_header():
                                 ID_INDEX                = 69,
                                 AUXTRACE_INFO           = 70,
                                 AUXTRACE                = 71,
-                                AUXTRACE_ERROR          = 72),
+                                AUXTRACE_ERROR          = 72,
+                                THREAD_MAP              = 73,
+                                CPU_MAP                 = 74,
+                                STAT_CONFIG             = 75,
+                                STAT                    = 76,
+                                STAT_ROUND              = 77,
+                                EVENT_UPDATE            = 78),
                            Embedded(BitStruct(None,
                                               Padding(1),
                                               Enum(BitField("cpumode", 7),
@@ -305,7 +311,31 @@ def perf_event():
                                                       SNInt32("tid"),
                                                       read_format(),
                                                       sample_id())),
-                              "SAMPLE": event()
+                              "SAMPLE": event(),
+                              "STAT_CONFIG": Struct("stat_config",
+                                                    UNInt64("nr"),
+                                                    Array(lambda ctx: ctx.nr,
+                                                          Struct("config",
+                                                                 Enum(UNInt64("tag"),
+                                                                      AGGR_MODE = 0,
+                                                                      INTERVAL = 1,
+                                                                      SCALE = 2),
+                                                                 UNInt64("val")))),
+                              "STAT": Struct("stat",
+                                             UNInt64("id"),
+                                             UNInt32("cpu"),
+                                             UNInt32("thread"),
+                                             UNInt64("val"),
+                                             UNInt64("ena"),
+                                             UNInt64("run")),
+                              "STAT_ROUND": Struct("stat_round",
+                                                   Enum(UNInt64("type"),
+                                                        INTERVAL = 0,
+                                                        FINAL = 1),
+                                                   UNInt64("time")),
+                              "THREAD_MAP": Pass,
+                              "CPU_MAP": Pass,
+                              "EVENT_UPDATE": Pass,
                            }),
 			Anchor("end"),
 			Padding(lambda ctx:
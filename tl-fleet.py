@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# aggregate toplev CSV output (toplev -I... -v -x, -o ...) and perf stat logs
+# (toplev --perf-output) of many hosts into distributions per node
+# tl-fleet.py logdir
+#
+# Every file in logdir (and its subdirectories) is one host. perf stat logs
+# are converted by toplev --import with --toplev-args, which need to match
+# the options used for collecting them.
+# toplev only prints the nodes above threshold without -v, so the node
+# distributions only cover all intervals when the CSV files were written
+# with -v. Files without any below node get a warning. For perf stat logs
+# -v is always added.
+import sys
+import os
+import re
+import argparse
+import subprocess
+import multiprocessing
+import json
+import heapq
+from collections import defaultdict, Counter
+import tldata
+from tl_stat import QuantileSketch
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+def parse_args():
+    p = argparse.ArgumentParser(usage='aggregate toplev -I... -v -x, output of many hosts')
+    p.add_argument('logdir', help='Directory with toplev CSV or toplev --perf-output files')
+    p.add_argument('--jobs', '-j', help='Number of files to process in parallel (default number of cpus)',
+                   type=int, default=multiprocessing.cpu_count())
+    p.add_argument('--toplev-args', help='toplev options to import perf stat logs, like "-l3 -I 1000". -v is always added',
+                   default="")
+    p.add_argument('--top', help='Number of hosts to show for each bottleneck', type=int, default=5)
+    p.add_argument('--json', help='Output as JSON', action='store_true')
+    p.add_argument('--output', '-o', help='Output file', type=argparse.FileType('w'), default=sys.stdout)
+    return p.parse_args()
+
+def is_perf_log(fn):
+    with open(fn) as f:
+        for l in f:
+            if not l.startswith("#") and l.strip():
+                return ";" in l
+    return False
+
+# the title a bottleneck is marked for: threads count with their core
+def unit(cpu):
+    return re.sub(r"-T\d+$", "", cpu) if cpu else cpu
+
+def socket_title(u):
+    return u is not None and re.match(r"S\d+$", u) is not None
+
+class Aggregate:
+    """Distributions of node values and bottleneck counts.
+       samples[host] is the number of intervals of the cores (or cpus or
+       sockets) of a host that can have a bottleneck, bottleneck[node][host]
+       the number of them with node as bottleneck."""
+    def __init__(self):
+        self.values = defaultdict(QuantileSketch)
+        self.sum = Counter()
+        self.samples = Counter()
+        self.bottleneck = defaultdict(Counter)
+
+    def add_interval(self, host, units, bns):
+        # socket titles next to cores are package nodes, which are never
+        # the bottleneck
+        cores = set([u for u in units if not socket_title(u)])
+        if cores:
+            units = cores
+        self.samples[host] += len(units)
+        for u, name in bns:
+            if u in units:
+                self.bottleneck[name][host] += 1
+
+    def add_file(self, host, f, fn):
+        last = None
+        units = set()
+        bns = set()
+        rows = below = 0
+        for ts, cpu, name, pct, state, helptxt, bn in tldata.read_rows(f):
+            rows += 1
+            if state.endswith("below"):
+                below += 1
+            self.values[name].add(pct)
+            self.sum[name] += pct
+            if ts != last:
+                self.add_interval(host, units, bns)
+                units, bns = set(), set()
+                last = ts
+            u = unit(cpu)
+            units.add(u)
+            if bn:
+                bns.add((u, name))
+        self.add_interval(host, units, bns)
+        if rows and not below:
+            print >>sys.stderr, ("%s: no nodes below threshold, not written with toplev -v? "
+                                 "The distributions only cover the printed nodes" % fn)
+
+    def merge(self, other):
+        for k, v in other.values.iteritems():
+            self.values[k].merge(v)
+        self.sum.update(other.sum)
+        self.samples.update(other.samples)
+        for k, v in other.bottleneck.iteritems():
+            self.bottleneck[k].update(v)
+
+    def result(self, top):
+        """Return the per node distributions and the top hosts per bottleneck."""
+        nodes = dict()
+        total = sum(self.samples.values())
+        for k, sk in self.values.iteritems():
+            d = {"count": sk.count, "mean": self.sum[k] / sk.count}
+            for q in QUANTILES:
+                d["p%d" % (q * 100)] = sk.quantile(q)
+            bn = sum(self.bottleneck[k].values()) if k in self.bottleneck else 0
+            d["bottleneck"] = float(bn) / total if total else 0.
+            nodes[k] = d
+        hosts = dict()
+        for k, c in self.bottleneck.iteritems():
+            share = [(float(n) / self.samples[h], h) for h, n in c.iteritems()]
+            hosts[k] = [(h, s) for s, h in heapq.nlargest(top, share)]
+        return {"hosts": len(self.samples), "nodes": nodes, "bottleneck_hosts": hosts}
+
+def process_file(job):
+    fn, host, toplev_args = job
+    agg = Aggregate()
+    try:
+        if is_perf_log(fn):
+            toplev = os.path.join(os.path.dirname(os.path.abspath(__file__)), "toplev.py")
+            targs = toplev_args.split()
+            if "-v" not in targs and "--verbose" not in targs:
+                targs.append("-v")
+            p = subprocess.Popen([toplev, "--import", fn, "-x,", "--quiet", "-o", "/dev/stdout"] +
+                                 targs, stdout=subprocess.PIPE)
+            agg.add_file(host, p.stdout, fn)
+            p.wait()
+        else:
+            with open(fn) as f:
+                agg.add_file(host, f, fn)
+    except (IOError, OSError) as e:
+        print >>sys.stderr, "%s: %s" % (fn, e)
+    return agg
+
+def find_files(logdir):
+    for root, dirs, files in os.walk(logdir):
+        for fn in sorted(files):
+            path = os.path.join(root, fn)
+            yield path, os.path.splitext(os.path.relpath(path, logdir))[0]
+
+def print_result(r, f):
+    print >>f, "%d hosts" % r["hosts"]
+    print >>f, "%-50s %10s %8s %8s %8s %8s %8s" % ("node", "count", "mean", "p50", "p90", "p99", "bottle")
+    for k in sorted(r["nodes"].keys()):
+        d = r["nodes"][k]
+        print >>f, "%-50s %10d %8.2f %8.2f %8.2f %8.2f %7.2f%%" % (
+                k, d["count"], d["mean"], d["p50"], d["p90"], d["p99"], 100. * d["bottleneck"])
+    for k in sorted(r["bottleneck_hosts"].keys()):
+        print >>f
+        print >>f, "Top hosts with bottleneck %s:" % k
+        for h, s in r["bottleneck_hosts"][k]:
+            print >>f, "  %-40s %7.2f%%" % (h, 100. * s)
+
+def main():
+    args = parse_args()
+    jobs = [(fn, host, args.toplev_args) for fn, host in find_files(args.logdir)]
+    pool = multiprocessing.Pool(args.jobs)
+    agg = Aggregate()
+    for a in pool.imap_unordered(process_file, jobs):
+        agg.merge(a)
+    pool.close()
+    pool.join()
+    r = agg.result(args.top)
+    if args.json:
+        json.dump(r, args.output, indent=1, sort_keys=True)
+        args.output.write("\n")
+    else:
+        print_result(r, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+# Copyright (c) 2017, Intel Corporation
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Columnar archive of raw counter values.
+#
+# The file starts with MAGIC, followed by records of a type byte and
+# a 32bit length:
+# H  json header describing the layout: the titles (cpus), the event
+#    names of every title, the event groups and model information.
+#    All following chunks use this layout until the next header.
+# C  chunk of intervals: 32bit interval count n, then (optionally zlib
+#    compressed) doubles: n timestamps, and n x width values, multiplex
+#    ratios and stddevs. width is the sum of the events of all titles,
+#    stored in title order for every interval.
+import struct
+import json
+import array
+import zlib
+
+MAGIC = "TLRAWAR1"
+VERSION = 1
+CHUNK = 64
+
+class FormatError(Exception):
+    pass
+
+def is_archive(fn):
+    with open(fn, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def write_record(f, typ, data):
+    f.write(typ + struct.pack("=I", len(data)) + data)
+
+class ArchiveWriter:
+    """Write counter values to file f. info is a dict with model
+       information stored in every header. compress is the zlib level,
+       0 disables compression. chunk is the number of intervals per chunk."""
+    def __init__(self, f, info, compress=1, chunk=CHUNK):
+        self.f = f
+        self.info = info
+        self.compress = compress
+        self.chunk = chunk
+        self.key = None
+        self.reset()
+        f.write(MAGIC)
+
+    def reset(self):
+        self.n = 0
+        self.ts = array.array('d')
+        self.vals = array.array('d')
+        self.mux = array.array('d')
+        self.stddev = array.array('d')
+
+    def header(self, titles, rev, groups):
+        names = []
+        nameidx = dict()
+        layouts = []
+        layoutidx = dict()
+        title_layout = []
+        for t in titles:
+            l = tuple(rev[t])
+            if l not in layoutidx:
+                for e in l:
+                    if e not in nameidx:
+                        nameidx[e] = len(names)
+                        names.append(e)
+                layoutidx[l] = len(layouts)
+                layouts.append([nameidx[e] for e in l])
+            title_layout.append(layoutidx[l])
+        h = {
+            "version": VERSION,
+            "info": self.info,
+            "compression": "zlib" if self.compress else "none",
+            "titles": titles,
+            "names": names,
+            "layouts": layouts,
+            "title_layout": title_layout,
+            "groups": [groups(len(l)) for l in layouts],
+        }
+        write_record(self.f, "H", json.dumps(h))
+
+    def write(self, timestamp, res, rev, valstats, groups=lambda n: None):
+        """Add one interval. res, rev and valstats are the per title
+           results of the ResultStore. groups(n) returns the group
+           numbers of a n event layout, or None if unknown."""
+        titles = sorted(res.keys())
+        # the ResultStore reuses its lists, so this is cheap
+        key = [(t, id(rev[t]), len(rev[t])) for t in titles]
+        if key != self.key:
+            self.flush()
+            self.header(titles, rev, groups)
+            self.key = key
+        self.ts.append(timestamp if timestamp is not None else float('nan'))
+        for t in titles:
+            self.vals.extend(res[t])
+            self.mux.extend(valstats[t].multiplex)
+            self.stddev.extend(valstats[t].stddev)
+        self.n += 1
+        if self.n >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        if self.n == 0:
+            return
+        data = "".join([a.tostring() for a in (self.ts, self.vals, self.mux, self.stddev)])
+        if self.compress:
+            data = zlib.compress(data, self.compress)
+        write_record(self.f, "C", struct.pack("=I", self.n) + data)
+        self.f.flush()
+        self.reset()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+class Segment:
+    """Part of the archive with the same layout.
+       titles, names, info like in the header. events[title] is the event
+       name list and groups[title] the group numbers (or None) of a title,
+       offset[title] its first column and width the number of columns."""
+    def __init__(self, h):
+        self.info = h["info"]
+        # json gives unicode
+        self.titles = map(str, h["titles"])
+        self.names = map(str, h["names"])
+        self.compressed = h["compression"] == "zlib"
+        self.events = dict()
+        self.groups = dict()
+        self.offset = dict()
+        self.width = 0
+        for t, l in zip(self.titles, h["title_layout"]):
+            self.events[t] = [self.names[i] for i in h["layouts"][l]]
+            self.groups[t] = h["groups"][l]
+            self.offset[t] = self.width
+            self.width += len(self.events[t])
+
+class Chunk:
+    """Intervals of a segment. The columns of interval i are at
+       i * segment.width in vals, multiplex and stddev."""
+    def __init__(self, seg, n, data):
+        if seg.compressed:
+            data = zlib.decompress(data)
+        a = array.array('d')
+        a.fromstring(data)
+        w = n * seg.width
+        if len(a) != n + 3 * w:
+            raise FormatError("bad chunk size")
+        self.n = n
+        self.timestamps = a[:n]
+        self.vals = a[n:n + w]
+        self.multiplex = a[n + w:n + 2*w]
+        self.stddev = a[n + 2*w:]
+
+class ArchiveReader:
+    """Read an archive written by ArchiveWriter."""
+    def __init__(self, fn):
+        self.f = open(fn, "rb")
+        if self.f.read(len(MAGIC)) != MAGIC:
+            raise FormatError("not a toplev raw archive")
+
+    def chunks(self):
+        """Yield (segment, chunk) for all chunks in the file."""
+        seg = None
+        while True:
+            h = self.f.read(5)
+            if len(h) == 0:
+                break
+            if len(h) < 5:
+                raise FormatError("truncated archive")
+            typ, size = h[0], struct.unpack("=I", h[1:])[0]
+            data = self.f.read(size)
+            if len(data) < size:
+                raise FormatError("truncated archive")
+            if typ == "H":
+                h = json.loads(data)
+                if h["version"] != VERSION:
+                    raise FormatError("unsupported archive version %s" % (h["version"],))
+                seg = Segment(h)
+            elif typ == "C":
+                if seg is None:
+                    raise FormatError("chunk before header")
+                yield seg, Chunk(seg, struct.unpack("=I", data[:4])[0], data[4:])
+            else:
+                raise FormatError("unknown record %r" % (typ,))
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,424 @@
+# Copyright (c) 2017, Intel Corporation
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Compile the compute methods of the toplev model nodes into a single
+# python function over a flat counter vector.
+#
+# Each node is traced once with symbolic values. Identical sub expressions
+# are shared between all nodes and only computed once per evaluation.
+# Data dependent branches (if, min, max) are traced for every outcome.
+# Nodes that cannot be traced use their normal compute method, and so does
+# any node that hits an exception (like division by zero) at run time.
+# This way the original compute methods stay the reference.
+# Nodes can be gated on another node: they are only computed when
+# the thresh of that node is true, otherwise they are skipped.
+import types
+
+MAX_PATHS = 32
+
+class NotCompilable(Exception):
+    pass
+
+class Unset:
+    pass
+
+def const_key(c):
+    return (type(c).__name__, c)
+
+def is_const(c):
+    return isinstance(c, (int, long, float, bool))
+
+def binop(op, swap=False):
+    def f(self, other):
+        if not isinstance(other, Expr) and not is_const(other):
+            raise NotCompilable()
+        if swap:
+            return self.comp.expr(op, (other, self))
+        return self.comp.expr(op, (self, other))
+    return f
+
+def not_compilable(self, *args):
+    raise NotCompilable()
+
+class Expr(object):
+    """Symbolic value while tracing a node."""
+    __slots__ = ('comp', 'op', 'args', 'num', 'volatile')
+
+    def __init__(self, comp, op, args, num, volatile):
+        self.comp = comp
+        self.op = op
+        self.args = args
+        self.num = num
+        self.volatile = volatile
+
+    __add__ = binop("+")
+    __radd__ = binop("+", True)
+    __sub__ = binop("-")
+    __rsub__ = binop("-", True)
+    __mul__ = binop("*")
+    __rmul__ = binop("*", True)
+    __div__ = binop("/")
+    __rdiv__ = binop("/", True)
+    __truediv__ = binop("/")
+    __rtruediv__ = binop("/", True)
+    __pow__ = binop("**")
+    __rpow__ = binop("**", True)
+    __and__ = binop("&")
+    __rand__ = binop("&", True)
+    __or__ = binop("|")
+    __ror__ = binop("|", True)
+    __lt__ = binop("<")
+    __le__ = binop("<=")
+    __gt__ = binop(">")
+    __ge__ = binop(">=")
+
+    def __neg__(self):
+        return self.comp.expr("neg", (self,))
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return self.comp.expr("abs", (self,))
+
+    def __nonzero__(self):
+        return self.comp.branch(self)
+
+    __eq__ = not_compilable
+    __ne__ = not_compilable
+    __hash__ = object.__hash__
+    __float__ = not_compilable
+    __int__ = not_compilable
+    __long__ = not_compilable
+    __index__ = not_compilable
+
+# op -> format
+leaf_ops = {
+    "v": "V[%d]",
+    "th": "TH(%d, %d)",
+    "env": "E[%r]",
+    "mux": "MUX()",
+    "attr": "o%d.%s",
+}
+
+def is_leaf(e):
+    return e.op in leaf_ops
+
+class Path:
+    def __init__(self, decisions, stmts, ref):
+        self.decisions = decisions
+        self.stmts = stmts
+        self.ref = ref
+
+class Branch:
+    def __init__(self, cond, true, false):
+        self.cond = cond
+        self.true = true
+        self.false = false
+
+def path_tree(paths, depth=0):
+    if len(paths) == 1 and len(paths[0].decisions) == depth:
+        return paths[0]
+    cond = paths[0].decisions[depth][0]
+    return Branch(cond,
+                  path_tree([p for p in paths if p.decisions[depth][1]], depth + 1),
+                  path_tree([p for p in paths if not p.decisions[depth][1]], depth + 1))
+
+def reachable_nodes(olist):
+    seen = dict()
+    todo = list(olist)
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen:
+            continue
+        seen[id(obj)] = obj
+        for v in obj.__dict__.values():
+            if isinstance(v, (list, tuple)):
+                todo += [x for x in v if hasattr(x, 'compute')]
+            elif hasattr(v, 'compute') and not isinstance(v, (types.FunctionType, types.MethodType)):
+                todo.append(v)
+    return seen.values()
+
+saved_attrs = ('val', 'thresh', 'compute')
+
+class Compiler:
+    """Trace the nodes in olist matching match and generate the evaluation
+       function. res_map is the event to index map of the runner.
+       nonperf are the events looked up in the environment.
+       guards has the gating node (or None) for every node in olist."""
+
+    def __init__(self, olist, match, threads, nonperf, guards=None):
+        self.exprs = dict()
+        self.olist = olist
+        self.guards = guards
+        self.threads = threads
+        self.nonperf = nonperf
+        self.objnum = dict()
+        self.objs = []
+        self.leaves = set()
+        self.compiled = 0
+        self.fallback = 0
+        nodes = reachable_nodes(olist)
+        saved = [(o, dict([(k, o.__dict__[k]) for k in saved_attrs if k in o.__dict__]))
+                 for o in nodes]
+        self.nodes = nodes
+        try:
+            for o in nodes:
+                o.compute = self.nested_compute(o)
+            self.trees = []
+            for obj in olist:
+                if not match(obj):
+                    self.trees.append(None)
+                    continue
+                try:
+                    self.trees.append(self.trace(obj))
+                    self.compiled += 1
+                except NotCompilable:
+                    self.trees.append(False)
+                    self.fallback += 1
+        finally:
+            for o, d in saved:
+                for k in saved_attrs:
+                    if k in d:
+                        o.__dict__[k] = d[k]
+                    elif k in o.__dict__:
+                        del o.__dict__[k]
+        self.source = self.gen_code()
+
+    def paths(self, t):
+        if isinstance(t, Branch):
+            return self.paths(t.true) + self.paths(t.false)
+        return [t]
+
+    def anded(self, e, leaf):
+        if e is leaf:
+            return True
+        return (isinstance(e, Expr) and e.op == "&" and
+                any([self.anded(a, leaf) for a in e.args]))
+
+    def gated(self, i, parent):
+        """Is the thresh of olist[i] always false when the thresh of parent is?
+           True when the node was traced and in every path its thresh is
+           False, or the thresh of parent anded with something."""
+        t = self.trees[i]
+        if not t or id(parent) not in self.objnum:
+            return False
+        leaf = self.expr("attr", (self.objnum[id(parent)], "thresh"), True)
+        obj = self.olist[i]
+        for p in self.paths(t):
+            thresh = [v for o, attr, v in p.stmts if o is obj and attr == 'thresh'][-1]
+            if thresh is not False and not self.anded(thresh, leaf):
+                return False
+        return True
+
+    def uses(self, i):
+        """Return the nodes whose val or thresh olist[i] uses, and the nodes
+           whose compute methods it calls, also through the called nodes.
+           None when the node was not traced."""
+        t = self.trees[i]
+        if not t:
+            return None
+        obj = self.olist[i]
+        reads = dict()
+        calls = dict()
+        seen = set()
+        def walk(e):
+            if not isinstance(e, Expr) or e.num in seen:
+                return
+            seen.add(e.num)
+            if e.op == "attr":
+                o = self.objs[e.args[0]]
+                reads[id(o)] = o
+            elif not is_leaf(e):
+                for a in e.args:
+                    walk(a)
+        for p in self.paths(t):
+            for cond, _ in p.decisions:
+                walk(cond)
+            for o, attr, v in p.stmts:
+                walk(v)
+                if o is not obj:
+                    calls[id(o)] = o
+        return reads.values(), calls.values()
+
+    def obj_index(self, o):
+        if id(o) not in self.objnum:
+            self.objnum[id(o)] = len(self.objs)
+            self.objs.append(o)
+        return self.objnum[id(o)]
+
+    def expr(self, op, args, volatile=False):
+        key = (op,) + tuple([("#", a.num) if isinstance(a, Expr) else const_key(a)
+                             for a in args])
+        if key in self.exprs:
+            return self.exprs[key]
+        volatile = volatile or any([a.volatile for a in args if isinstance(a, Expr)])
+        e = Expr(self, op, args, len(self.exprs), volatile)
+        self.exprs[key] = e
+        return e
+
+    def branch(self, cond):
+        if cond.volatile:
+            raise NotCompilable()
+        j = len(self.decisions)
+        val = self.forced[j] if j < len(self.forced) else True
+        self.decisions.append((cond, val))
+        return val
+
+    def lookup(self, obj, ev, level, off):
+        if isinstance(ev, types.LambdaType):
+            if off is not None:
+                raise NotCompilable()
+            return sum([ev(lambda ev, level: self.lookup(obj, ev, level, t), level)
+                        for t in range(self.threads)])
+        if ev in self.nonperf:
+            if ev == "mux":
+                return self.expr("mux", ())
+            return self.expr("env", (ev,))
+        key = (ev, level, obj.name)
+        if key not in obj.res_map:
+            raise NotCompilable()
+        index = obj.res_map[key]
+        self.ref.add(index)
+        self.leaves.add((index, ev))
+        if off is not None:
+            return self.expr("th", (index, off))
+        return self.expr("v", (index,))
+
+    def nested_compute(self, o):
+        def compute(EV):
+            v = o.__class__.compute(o, EV)
+            self.stmts.append((o, 'val', o.val))
+            self.stmts.append((o, 'thresh', o.thresh))
+            return v
+        return compute
+
+    def reset_nodes(self):
+        for o in self.nodes:
+            n = self.obj_index(o)
+            o.val = self.expr("attr", (n, "val"), True)
+            o.thresh = self.expr("attr", (n, "thresh"), True)
+
+    def trace(self, obj):
+        paths = []
+        todo = [[]]
+        while todo:
+            if len(paths) >= MAX_PATHS:
+                raise NotCompilable()
+            self.forced = todo.pop()
+            self.decisions = []
+            self.stmts = []
+            self.ref = set()
+            self.reset_nodes()
+            try:
+                obj.__class__.compute(obj, lambda ev, level: self.lookup(obj, ev, level, None))
+            except (TypeError, AttributeError, KeyError, IndexError, ValueError,
+                    ZeroDivisionError):
+                raise NotCompilable()
+            self.stmts.append((obj, 'val', obj.val))
+            self.stmts.append((obj, 'thresh', obj.thresh))
+            paths.append(Path(self.decisions, self.stmts, frozenset(self.ref)))
+            for j in range(len(self.forced), len(self.decisions)):
+                todo.append([d[1] for d in self.decisions[:j]] + [not self.decisions[j][1]])
+        return path_tree(paths)
+
+    def render(self, e):
+        if not isinstance(e, Expr):
+            return repr(e)
+        if is_leaf(e):
+            return leaf_ops[e.op] % e.args
+        if not e.volatile:
+            return "t%d" % e.num
+        return self.render_op(e)
+
+    def render_op(self, e):
+        a = [self.render(x) for x in e.args]
+        if e.op == "neg":
+            return "(-%s)" % a[0]
+        if e.op == "abs":
+            return "abs(%s)" % a[0]
+        return "(%s %s %s)" % (a[0], e.op, a[1])
+
+    def ensure(self, e, defined, out, indent):
+        if not isinstance(e, Expr) or is_leaf(e):
+            return
+        for a in e.args:
+            self.ensure(a, defined, out, indent)
+        if e.volatile or e.num in defined:
+            return
+        if e.num in self.temps:
+            out.append("%sif t%d is U: t%d = %s" % (indent, e.num, e.num, self.render_op(e)))
+        else:
+            out.append("%st%d = %s" % (indent, e.num, self.render_op(e)))
+            self.temps.add(e.num)
+        defined.add(e.num)
+
+    def gen_tree(self, t, defined, out, indent):
+        if isinstance(t, Branch):
+            self.ensure(t.cond, defined, out, indent)
+            out.append("%sif %s:" % (indent, self.render(t.cond)))
+            self.gen_tree(t.true, set(defined), out, indent + "    ")
+            out.append("%selse:" % indent)
+            self.gen_tree(t.false, set(defined), out, indent + "    ")
+            return
+        for o, attr, val in t.stmts:
+            self.ensure(val, defined, out, indent)
+            out.append("%so%d.%s = %s" % (indent, self.obj_index(o), attr, self.render(val)))
+        if t.ref not in self.refs:
+            self.refs[t.ref] = "R%d" % len(self.refs)
+        out.append("%sr = %s" % (indent, self.refs[t.ref]))
+
+    def gen_code(self):
+        self.temps = set()
+        self.refs = dict()
+        body = []
+        for i, obj in enumerate(self.olist):
+            body.append("    o%d.errcount = 0" % self.obj_index(obj))
+            t = self.trees[i]
+            if t is None:
+                continue
+            ind = "    "
+            if self.guards and self.guards[i] is not None:
+                body.append("    if not o%d.thresh:" % self.obj_index(self.guards[i]))
+                body.append("        S(%d)" % i)
+                body.append("    else:")
+                ind = "        "
+            if t is False:
+                body.append(ind + "F(%d)" % i)
+                continue
+            body.append(ind + "try:")
+            self.gen_tree(t, set(), body, ind + "    ")
+            body.append(ind + "except ZeroDivisionError:")
+            body.append(ind + "    F(%d)" % i)
+            body.append(ind + "else:")
+            body.append(ind + "    P(%d, r)" % i)
+        out = ["def compute(V, TH, E, MUX, F, P, S):"]
+        temps = sorted(self.temps)
+        for j in range(0, len(temps), 16):
+            out.append("    " + " = ".join(["t%d" % x for x in temps[j:j+16]]) + " = U")
+        return "\n".join(out + body + ["    pass"]) + "\n"
+
+    def function(self):
+        """Return the generated function.
+           Call as f(V, TH, E, MUX, F, P, S).
+           V is the flat counter vector, TH(index, offset) returns the
+           value of a single thread, E is the environment and MUX() returns
+           the multiplex ratio. F(i) computes olist[i] using the reference
+           path and P(i, ref) post processes it with the set of referenced
+           counter indexes. S(i) is called for skipped gated nodes."""
+        ns = dict()
+        ns['U'] = Unset
+        for n, o in enumerate(self.objs):
+            ns["o%d" % n] = o
+        for ref, name in self.refs.items():
+            ns[name] = ref
+        exec compile(self.source, "<toplev model>", "exec") in ns
+        return ns['compute']
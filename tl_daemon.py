@@ -0,0 +1,156 @@
+# Copyright (c) 2017, Intel Corporation
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# toplev daemon mode: keep the computed node values of the last intervals
+# in a ring buffer, and answer queries on a local unix socket.
+#
+# Queries are single lines:
+# last SECONDS [NODE [CPU]]  all values of the last SECONDS seconds
+# bottleneck [CPU]           the bottleneck of the last interval
+# help
+# NODE and CPU are shell patterns, like Frontend_Bound* or S0-C*.
+# The answers are formatted like the normal toplev output. All nodes are
+# kept, the nodes below their threshold are marked below.
+import os
+import threading
+import SocketServer
+from fnmatch import fnmatch
+from collections import deque, namedtuple
+import tl_output
+
+# kind is ratio or metric, remark is the unit, below is true when
+# the node is below its threshold
+Item = namedtuple("Item", ["kind", "area", "name", "val", "remark", "title", "bn", "below"])
+
+class Ring:
+    """The node values of the last size intervals."""
+    def __init__(self, size):
+        self.intervals = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, timestamp, items):
+        with self.lock:
+            self.intervals.append((timestamp, items))
+
+    def last(self, seconds):
+        """Return the intervals of the last seconds seconds as (timestamp, items),
+           oldest first."""
+        l = []
+        with self.lock:
+            if not self.intervals:
+                return l
+            start = self.intervals[-1][0] - seconds
+            for iv in reversed(self.intervals):
+                if iv[0] <= start:
+                    break
+                l.append(iv)
+        l.reverse()
+        return l
+
+    def current(self):
+        """Return the last interval as a list of (timestamp, items)."""
+        with self.lock:
+            return [self.intervals[-1]] if self.intervals else []
+
+class OutputRing(tl_output.Output):
+    """Output into a Ring. Every flush ends an interval."""
+    def __init__(self, ring, logfile, version):
+        tl_output.Output.__init__(self, logfile, version)
+        self.ring = ring
+        self.items = []
+        self.timestamp = None
+
+    def ratio(self, area, name, l, timestamp, remark, desc, title, sample, valstat, bn):
+        self.timestamp = timestamp
+        below = remark.endswith(" below")
+        if below:
+            remark = remark[:-len(" below")]
+        self.items.append(Item("ratio", area, name, l, remark, title, bn, below))
+
+    def metric(self, area, name, l, timestamp, desc, title, unit, valstat):
+        self.timestamp = timestamp
+        self.items.append(Item("metric", area, name, l, unit, title, "", False))
+
+    def flush(self):
+        if self.items:
+            self.ring.add(self.timestamp, self.items)
+            self.items = []
+
+# print items with a toplev output
+def replay(out, timestamp, items):
+    if not items:
+        return
+    out.set_cpus(sorted(set([i.title for i in items if i.title])))
+    for i in items:
+        out.set_hdr(i.name, i.area)
+        out.set_unit(i.remark + (" below" if i.below else ""))
+    for i in items:
+        if i.kind == "ratio":
+            out.ratio(i.area, i.name, i.val, timestamp, i.remark + (" below" if i.below else ""),
+                      "", i.title, None, None, i.bn)
+        else:
+            out.metric(i.area, i.name, i.val, timestamp, "", i.title, i.remark, None)
+    out.flush()
+
+def match(pattern, s):
+    return pattern == "*" or fnmatch(s or "", pattern)
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for l in iter(self.rfile.readline, ""):
+            try:
+                self.server.query(l.split(), self.wfile)
+            except (ValueError, IndexError):
+                self.wfile.write("error: cannot parse query %s" % l)
+            self.wfile.flush()
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Answer queries on ring at unix socket path. Answers are written with
+       the output returned by make_output(file)."""
+    daemon_threads = True
+
+    def __init__(self, path, ring, make_output):
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, QueryHandler)
+        self.path = path
+        self.ring = ring
+        self.make_output = make_output
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        os.unlink(self.path)
+
+    def query(self, q, f):
+        if not q:
+            return
+        if q[0] == "last":
+            seconds = float(q[1])
+            node = q[2] if len(q) > 2 else "*"
+            cpu = q[3] if len(q) > 3 else "*"
+            out = self.make_output(f)
+            for ts, items in self.ring.last(seconds):
+                replay(out, ts, [i for i in items if match(node, i.name) and match(cpu, i.title)])
+        elif q[0] == "bottleneck":
+            cpu = q[1] if len(q) > 1 else "*"
+            out = self.make_output(f)
+            for ts, items in self.ring.current():
+                replay(out, ts, [i for i in items if i.bn and match(cpu, i.title)])
+        elif q[0] == "help":
+            f.write("last SECONDS [NODE [CPU]]\nbottleneck [CPU]\n")
+        else:
+            f.write("error: unknown query %s\n" % q[0])
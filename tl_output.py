@@ -58,6 +58,10 @@ class Output:
     def flush(self):
         pass
 
+    # print a comment line into the output, like a change of settings
+    def note(self, msg):
+        self.logf.write("# " + msg + "\n")
+
 class OutputHuman(Output):
     """Generate human readable single-column output."""
     def __init__(self, logfile, args, version, cpu):
@@ -208,6 +212,9 @@ class OutputColumnsCSV(OutputColumns):
         self.printed_header = False
         self.writer.writerow(["# " + version + " on " + cpu.name])
 
+    def note(self, msg):
+        self.writer.writerow(["# " + msg])
+
     # XXX implement bn
     def show(self, timestamp, title, area, hdr, s, remark, desc, sample, valstat, bn):
         self.timestamp = timestamp
@@ -261,6 +268,9 @@ class OutputCSV(Output):
         self.args = args
         self.writer.writerow(["# " + version + " on " + cpu.name])
 
+    def note(self, msg):
+        self.writer.writerow(["# " + msg])
+
     def show(self, timestamp, title, area, hdr, s, remark, desc, sample, valstat, bn):
         if self.args.no_desc:
             desc = ""
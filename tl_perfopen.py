@@ -0,0 +1,310 @@
+# Copyright (c) 2017, Intel Corporation
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Count event groups directly with perf_event_open, without running perf.
+# Understands the event syntax toplev generates: generic hardware and
+# software events, pmu/term=val,.../ with the formats from sysfs,
+# raw rXXXX events and tracepoints, with :k/:u/:h or /k /u /h modifiers.
+import os
+import re
+import struct
+import ctypes
+import errno
+import platform
+
+PERF_TYPE_HARDWARE = 0
+PERF_TYPE_SOFTWARE = 1
+PERF_TYPE_TRACEPOINT = 2
+PERF_TYPE_RAW = 4
+
+PERF_FORMAT_TOTAL_TIME_ENABLED = 1
+PERF_FORMAT_TOTAL_TIME_RUNNING = 2
+PERF_FORMAT_GROUP = 8
+
+ATTR_DISABLED = 1 << 0
+ATTR_INHERIT = 1 << 1
+ATTR_EXCLUDE_USER = 1 << 4
+ATTR_EXCLUDE_KERNEL = 1 << 5
+ATTR_EXCLUDE_HV = 1 << 6
+ATTR_ENABLE_ON_EXEC = 1 << 12
+
+PERF_ATTR_SIZE = 112
+attr_format = "=IIQQQQQIIQQQQIiQIHH"
+
+syscall_nr = {
+    "x86_64": 298,
+    "i386": 336,
+    "i686": 336,
+}
+
+hw_events = {
+    "cycles": 0,
+    "cpu-cycles": 0,
+    "instructions": 1,
+    "cache-references": 2,
+    "cache-misses": 3,
+    "branches": 4,
+    "branch-instructions": 4,
+    "branch-misses": 5,
+    "bus-cycles": 6,
+    "ref-cycles": 9,
+}
+
+sw_events = {
+    "cpu-clock": 0,
+    "task-clock": 1,
+    "page-faults": 2,
+    "faults": 2,
+    "context-switches": 3,
+    "cs": 3,
+    "cpu-migrations": 4,
+    "migrations": 4,
+    "minor-faults": 5,
+    "major-faults": 6,
+    "alignment-faults": 7,
+    "emulation-faults": 8,
+    "dummy": 9,
+}
+
+sysfs = "/sys/bus/event_source/devices"
+tracefs = ("/sys/kernel/debug/tracing/events", "/sys/kernel/tracing/events")
+
+class EventError(Exception):
+    pass
+
+def read_file(fn):
+    with open(fn, "r") as f:
+        return f.read().strip()
+
+def parse_cpus(s):
+    cpus = []
+    for r in s.split(","):
+        if "-" in r:
+            a, b = r.split("-")
+            cpus += range(int(a), int(b) + 1)
+        elif r:
+            cpus.append(int(r))
+    return cpus
+
+class Event:
+    """A parsed event."""
+    def __init__(self, name):
+        self.name = name
+        self.type = 0
+        self.config = [0, 0, 0] # config, config1, config2
+        self.flags = 0
+        self.scale = 1.0
+        self.cpus = None # limited to these cpus, like uncore events
+
+    def attr(self, read_format, flags):
+        return struct.pack(attr_format,
+                           self.type, PERF_ATTR_SIZE, self.config[0], 0, 0,
+                           read_format, self.flags | flags, 0, 0,
+                           self.config[1], self.config[2],
+                           0, 0, 0, 0, 0, 0, 0, 0)
+
+# like perf, u, k and h select the modes to count, the others are excluded
+def set_modifiers(e, mods):
+    for m in mods:
+        if m not in "ukhpP":
+            raise EventError("%s: unsupported modifier %s" % (e.name, m))
+    if not any(m in mods for m in "ukh"):
+        return
+    if "u" not in mods:
+        e.flags |= ATTR_EXCLUDE_USER
+    if "k" not in mods:
+        e.flags |= ATTR_EXCLUDE_KERNEL
+    if "h" not in mods:
+        e.flags |= ATTR_EXCLUDE_HV
+
+# put val into the fields of the format spec, like config:0-7,32-35
+def set_format(e, spec, val):
+    m = re.match(r"(config[12]?):(.*)", spec)
+    if not m:
+        raise EventError("%s: unknown format %s" % (e.name, spec))
+    n = {"config": 0, "config1": 1, "config2": 2}[m.group(1)]
+    for r in m.group(2).split(","):
+        if "-" in r:
+            lo, hi = map(int, r.split("-"))
+        else:
+            lo = hi = int(r)
+        width = hi - lo + 1
+        e.config[n] |= (val & ((1 << width) - 1)) << lo
+        val >>= width
+
+def set_terms(e, pmu, terms):
+    for t in terms.split(","):
+        if not t:
+            continue
+        if "=" in t:
+            k, v = t.split("=", 1)
+        else:
+            k, v = t, "1"
+        d = "%s/%s" % (sysfs, pmu)
+        if k in ("name", "period"):
+            continue
+        if os.path.exists("%s/format/%s" % (d, k)):
+            set_format(e, read_file("%s/format/%s" % (d, k)), int(v, 0))
+        elif os.path.exists("%s/events/%s" % (d, k)):
+            # named event of the pmu, like msr/tsc/
+            set_terms(e, pmu, read_file("%s/events/%s" % (d, k)))
+            if os.path.exists("%s/events/%s.scale" % (d, k)):
+                e.scale = float(read_file("%s/events/%s.scale" % (d, k)))
+        else:
+            raise EventError("%s: unknown term %s for %s" % (e.name, k, pmu))
+
+def parse_event(name):
+    e = Event(name)
+    m = re.match(r"([a-z0-9_]+)/(.*)/([a-zA-Z]*)$", name)
+    if m:
+        pmu = m.group(1)
+        try:
+            e.type = int(read_file("%s/%s/type" % (sysfs, pmu)))
+        except IOError:
+            raise EventError("%s: pmu %s does not exist" % (name, pmu))
+        set_terms(e, pmu, m.group(2))
+        set_modifiers(e, m.group(3))
+        if os.path.exists("%s/%s/cpumask" % (sysfs, pmu)):
+            e.cpus = parse_cpus(read_file("%s/%s/cpumask" % (sysfs, pmu)))
+        return e
+    m = re.match(r"(.*?)(?::([ukhpP]+))?$", name)
+    ev, mods = m.group(1), m.group(2)
+    set_modifiers(e, mods or "")
+    if ev in hw_events:
+        e.type, e.config[0] = PERF_TYPE_HARDWARE, hw_events[ev]
+    elif ev in sw_events:
+        e.type, e.config[0] = PERF_TYPE_SOFTWARE, sw_events[ev]
+    elif re.match(r"r[0-9a-fA-F]+$", ev):
+        e.type, e.config[0] = PERF_TYPE_RAW, int(ev[1:], 16)
+    elif ":" in ev:
+        e.type = PERF_TYPE_TRACEPOINT
+        for d in tracefs:
+            fn = "%s/%s/id" % (d, ev.replace(":", "/"))
+            if os.path.exists(fn):
+                e.config[0] = int(read_file(fn))
+                break
+        else:
+            raise EventError("%s: tracepoint not found" % (name,))
+    else:
+        raise EventError("%s: unknown event" % (name,))
+    return e
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+def perf_event_open(attr, pid, cpu, group_fd, flags=0):
+    nr = syscall_nr.get(platform.machine())
+    if nr is None:
+        raise EventError("perf_event_open not supported on " + platform.machine())
+    buf = ctypes.create_string_buffer(attr, len(attr))
+    fd = libc.syscall(nr, buf, pid, cpu, group_fd, flags)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return fd
+
+class Group:
+    """A group of events opened on one cpu or task."""
+    def __init__(self, events, grouped, pid, cpu, flags):
+        self.events = events
+        self.fds = []
+        self.prev = None
+        fmt = (PERF_FORMAT_TOTAL_TIME_ENABLED | PERF_FORMAT_TOTAL_TIME_RUNNING |
+               (PERF_FORMAT_GROUP if grouped else 0))
+        try:
+            for e in events:
+                leader = self.fds[0] if grouped and self.fds else -1
+                self.fds.append(perf_event_open(e.attr(fmt, flags), pid, cpu, leader))
+        except OSError as err:
+            self.close()
+            if err.errno not in (errno.ENOENT, errno.EINVAL, errno.EOPNOTSUPP):
+                raise EventError("%s: %s" % (e.name, err.strerror))
+        self.grouped = grouped
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+    def read_raw(self):
+        if self.grouped:
+            n = len(self.events)
+            d = struct.unpack("=%dQ" % (3 + n), os.read(self.fds[0], 8 * (3 + n)))
+            return [(v, d[1], d[2]) for v in d[3:]]
+        return [struct.unpack("=QQQ", os.read(fd, 24)) for fd in self.fds]
+
+    def read(self):
+        """Return a list of (value, enabled, running) since the last read,
+           or None when the group could not be opened."""
+        if not self.fds:
+            return None
+        cur = self.read_raw()
+        prev = self.prev or [(0, 0, 0)] * len(cur)
+        self.prev = cur
+        return [(c[0] - p[0], c[1] - p[1], c[2] - p[2]) for c, p in zip(cur, prev)]
+
+class Collector:
+    """Count groups of events on cpus or for tasks.
+       groups is a list of (event name list, grouped).
+       Either cpus is a list of cpus to count system wide, or pids a list
+       of tasks to count (with inherit). With enable_on_exec the counters
+       start when the task calls exec. With aggregate the cpus are summed."""
+    def __init__(self, groups, cpus=None, pids=None, enable_on_exec=False, aggregate=False):
+        self.events = [[parse_event(e) for e in g] for g, _ in groups]
+        self.units = []
+        flags = 0
+        if pids:
+            flags |= ATTR_INHERIT
+            if enable_on_exec:
+                flags |= ATTR_DISABLED | ATTR_ENABLE_ON_EXEC
+        self.cpus = cpus or []
+        self.aggregate = bool(pids) or aggregate
+        for evl, (_, grouped) in zip(self.events, groups):
+            gcpus = self.cpus
+            if cpus and evl[0].cpus is not None:
+                gcpus = [c for c in cpus if c in evl[0].cpus]
+            if pids:
+                self.units.append([(None, Group(evl, grouped, pid, -1, flags)) for pid in pids])
+            else:
+                self.units.append([(c, Group(evl, grouped, -1, c, flags)) for c in gcpus])
+
+    def read(self):
+        """Read the counts since the last read. Return a list of
+           (cpu, event name, value, multiplex percent) in group order
+           with the values scaled for multiplexing. For tasks or with
+           aggregate cpu is None and the values are summed. The value
+           is None when the event was not counted."""
+        res = []
+        for evl, unit in zip(self.events, self.units):
+            total = [None] * len(evl)
+            for c, g in unit:
+                r = g.read()
+                if self.aggregate:
+                    if r:
+                        total = [tuple(map(sum, zip(t or (0, 0, 0), x)))
+                                 for t, x in zip(total, r)]
+                    continue
+                for j, e in enumerate(evl):
+                    res.append(scale(c, e, *r[j]) if r else (c, e.name, None, 0.))
+            if self.aggregate:
+                for e, t in zip(evl, total):
+                    res.append(scale(None, e, *t) if t else (None, e.name, None, 0.))
+        return res
+
+    def close(self):
+        for unit in self.units:
+            for _, g in unit:
+                g.close()
+
+def scale(cpu, e, val, enabled, running):
+    if running == 0:
+        return (cpu, e.name, None, 0.)
+    return (cpu, e.name, val * e.scale * (float(enabled) / running),
+            100.0 * running / enabled)
@@ -0,0 +1,147 @@
+# Copyright (c) 2017, Intel Corporation
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Serve the values of the last toplev interval in the Prometheus text
+# exposition format.
+#
+# toplev_node_ratio{node="Frontend_Bound",area="FE",cpu="0"} 0.25
+# toplev_metric{metric="IPC",cpu="0"} 1.5
+# toplev_node_above_threshold{node="Frontend_Bound",area="FE",cpu="0"} 0
+# toplev_bottleneck{node="Backend_Bound.Memory_Bound",area="BE",cpu="0"} 1
+#
+# All computed nodes are exported every interval, also when below their
+# threshold, so that the series don't come and go between scrapes.
+# The cpu label can be aggregated to core or socket labels (or none) to
+# limit the number of series on large systems. Values of aggregated cpus
+# are averaged, cpus above threshold and bottlenecks are counted.
+import re
+import threading
+import BaseHTTPServer
+import tl_output
+
+FAMILIES = (
+    ("toplev_node_ratio", "node", "TopDown node value as fraction of its domain"),
+    ("toplev_metric", "metric", "toplev metric value"),
+    ("toplev_node_above_threshold", "node", "Number of cpus with the node above its threshold"),
+    ("toplev_bottleneck", "node", "Number of cpus with the node as bottleneck"),
+)
+
+COUNTED = ("toplev_node_above_threshold", "toplev_bottleneck")
+
+title_re = re.compile(r"(S\d+)?-?(C\d+)?-?(T\d+)?$")
+
+def title_labels(title, aggregate, cpu):
+    """Return the labels of a toplev cpu, thread, core or socket title when
+       aggregating to aggregate (cpu, core, socket or none)."""
+    if aggregate == "none" or title == "":
+        return ()
+    if aggregate == "cpu":
+        return (("cpu", title),)
+    if title.isdigit():
+        socket, core = cpu.cputocore[int(title)]
+        s, c = "S%d" % socket, "C%d" % core
+    else:
+        m = title_re.match(title)
+        if not m:
+            return (("cpu", title),)
+        s, c = m.group(1) or "S0", m.group(2)
+    if aggregate == "core" and c:
+        return (("core", "%s-%s" % (s, c) if cpu.sockets > 1 else c),)
+    return (("socket", s),)
+
+def escape(s):
+    return s.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+class OutputPrometheus(tl_output.Output):
+    """Keep the values of the last interval for scraping. labels(title) returns
+       the labels of a title."""
+    def __init__(self, logfile, version, labels):
+        tl_output.Output.__init__(self, logfile, version)
+        self.labels = labels
+        self.cur = dict()
+        self.last = dict()
+        self.timestamp = None
+        self.page = None
+        self.lock = threading.Lock()
+
+    def add(self, family, name, area, val, title):
+        key = (family, name, area, self.labels(title))
+        v = self.cur.get(key)
+        if v:
+            v[0] += val
+            v[1] += 1
+        else:
+            self.cur[key] = [val, 1]
+
+    def ratio(self, area, name, l, timestamp, remark, desc, title, sample, valstat, bn):
+        self.timestamp = timestamp
+        self.add("toplev_node_ratio", name, area, l, title)
+        self.add("toplev_node_above_threshold", name, area,
+                 0. if remark and "below" in remark else 1., title)
+        self.add("toplev_bottleneck", name, area, 1. if bn else 0., title)
+
+    def metric(self, area, name, l, timestamp, desc, title, unit, valstat):
+        self.timestamp = timestamp
+        self.add("toplev_metric", name, None, l, title)
+
+    def flush(self):
+        if self.cur:
+            with self.lock:
+                self.last = self.cur
+                self.page = None
+            self.cur = dict()
+
+    def render(self):
+        """Return the page of the last interval. Only rendered once."""
+        with self.lock:
+            if self.page is None:
+                self.page = self.format(self.last)
+            return self.page
+
+    def format(self, values):
+        l = []
+        for family, label, desc in FAMILIES:
+            l.append("# HELP %s %s\n# TYPE %s gauge\n" % (family, desc, family))
+            for (fam, name, area, labels), (val, num) in sorted(values.items()):
+                if fam != family:
+                    continue
+                lab = [(label, name)] + ([("area", area)] if area else []) + list(labels)
+                if family not in COUNTED:
+                    val /= num
+                l.append("%s{%s} %s\n" % (family,
+                    ",".join(['%s="%s"' % (k, escape(v)) for k, v in lab]), repr(val)))
+        return "".join(l)
+
+class ScrapeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        page = self.server.out.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, format, *args):
+        pass
+
+class ScrapeServer(BaseHTTPServer.HTTPServer):
+    """Serve the last interval of out on (host, port) in a thread."""
+    def __init__(self, addr, out):
+        BaseHTTPServer.HTTPServer.__init__(self, addr, ScrapeHandler)
+        self.out = out
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
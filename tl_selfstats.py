@@ -0,0 +1,107 @@
+# Copyright (c) 2017, Intel Corporation
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Measure the overhead of toplev itself.
+# Accounts the time spent in the phases of every interval, the CPU time
+# and memory of the toplev process, and the number of perf output lines
+# and events processed. Writes one CSV record per interval and prints
+# a summary at the end.
+import sys
+import time
+import resource
+from collections import Counter
+
+PHASES = ("parse", "compute", "print", "flush")
+
+def rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def cputime(ru):
+    return ru.ru_utime + ru.ru_stime
+
+class SelfStats:
+    """Collect self statistics and write them to file f (or nowhere when
+       f is None). time[phase] is the time spent in the phase in the
+       current interval."""
+    def __init__(self, f):
+        self.f = f
+        self.time = Counter()
+        self.total = Counter()
+        self.lines = 0
+        self.last_lines = 0
+        self.events = 0
+        self.intervals = 0
+        self.max_rss = 0
+        self.start = self.last = time.time()
+        self.ru_start = self.ru = resource.getrusage(resource.RUSAGE_SELF)
+        if f:
+            f.write(",".join(("timestamp", "wall") + PHASES +
+                             ("user", "sys", "rss", "lines", "events",
+                              "lines/s", "events/s")) + "\n")
+
+    def timed(self, phase, func):
+        """Return func wrapped to account its run time to phase."""
+        def wrapper(*args, **kw):
+            t = time.time()
+            try:
+                return func(*args, **kw)
+            finally:
+                self.time[phase] += time.time() - t
+        return wrapper
+
+    def add(self, phase, t):
+        self.time[phase] += time.time() - t
+
+    def interval(self, timestamp, events):
+        """Finish an interval of events counter values."""
+        now = time.time()
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        wall = now - self.last
+        cur = rss()
+        self.max_rss = max(self.max_rss, cur)
+        self.events += events
+        self.intervals += 1
+        self.total.update(self.time)
+        lines = self.lines - self.last_lines
+        if self.f:
+            rate = lambda n: "%.1f" % (n / wall) if wall > 0 else ""
+            self.f.write(",".join([str(timestamp), "%.6f" % wall] +
+                                  ["%.6f" % self.time[p] for p in PHASES] +
+                                  ["%.6f" % (ru.ru_utime - self.ru.ru_utime),
+                                   "%.6f" % (ru.ru_stime - self.ru.ru_stime),
+                                   "%d" % cur,
+                                   "%d" % lines,
+                                   "%d" % events,
+                                   rate(lines),
+                                   rate(events)]) + "\n")
+        self.last_lines = self.lines
+        self.time.clear()
+        self.last = now
+        self.ru = ru
+
+    def summary(self, f=sys.stderr):
+        if self.f:
+            self.f.flush()
+        wall = time.time() - self.start
+        cpu = cputime(resource.getrusage(resource.RUSAGE_SELF)) - cputime(self.ru_start)
+        perf = cputime(resource.getrusage(resource.RUSAGE_CHILDREN))
+        print >>f, "toplev self stats: %d intervals in %.2fs" % (self.intervals, wall)
+        for p in PHASES:
+            print >>f, "  %-8s %10.3fs" % (p, self.total[p])
+        print >>f, "  cpu      %10.3fs (%.2f%% of wall time)" % (cpu, 100.0 * cpu / wall if wall else 0.)
+        print >>f, "  children %10.3fs" % (perf,)
+        print >>f, "  max rss  %10.1fMB" % (max(self.max_rss, rss()) / (1024. * 1024),)
+        if wall > 0:
+            print >>f, "  %.1f lines/s %.1f events/s" % (self.lines / wall, self.events / wall)
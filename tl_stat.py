@@ -13,10 +13,33 @@
 # Maintain error data on perf measurements
 import sys
 import math
-from collections import namedtuple
+import itertools
+import array
+from collections import namedtuple, Counter
 
 ValStat = namedtuple('ValStat', ['stddev', 'multiplex'])
 
+class ValStats:
+    """Sequence of ValStats backed by parallel stddev and multiplex arrays."""
+    def __init__(self, stddev, multiplex):
+        self.stddev = stddev
+        self.multiplex = multiplex
+
+    def __len__(self):
+        return len(self.stddev)
+
+    def __getitem__(self, i):
+        return ValStat(self.stddev[i], self.multiplex[i])
+
+    def __iter__(self):
+        return itertools.imap(ValStat, self.stddev, self.multiplex)
+
+    def combine(self, ref):
+        if not ref:
+            return []
+        return ValStat(geoadd([self.stddev[i] for i in ref]),
+                       min([self.multiplex[i] for i in ref]))
+
 def geoadd(l):
     return math.sqrt(sum([x**2 for x in l]))
 
@@ -27,6 +50,12 @@ def combine_valstat(l):
         return []
     return ValStat(geoadd([x.stddev for x in l]), min([x.multiplex for x in l]))
 
+# combine the valstats of the result indexes in ref
+def combine_ref(valstats, ref):
+    if isinstance(valstats, ValStats):
+        return valstats.combine(ref)
+    return combine_valstat([valstats[i] for i in ref])
+
 def isnan(x):
     return x != x
 
@@ -41,6 +70,119 @@ def format_valstat(valstat):
         vs = "%8s" % vs
     return vs
 
+class RunningStats:
+    """Running statistics of a vector of counters over intervals with
+       fixed state: sum, mean and variance (Welford), min, max,
+       the combined stddev and the average multiplex ratio."""
+    def __init__(self, n):
+        self.n = 0
+        self.sum = array.array('d', [0.] * n)
+        self.mean = array.array('d', [0.] * n)
+        self.m2 = array.array('d', [0.] * n)
+        self.min = array.array('d', [float('inf')] * n)
+        self.max = array.array('d', [float('-inf')] * n)
+        self.var_stddev = array.array('d', [0.] * n)
+        self.sum_multiplex = array.array('d', [0.] * n)
+
+    def add(self, vals, valstats):
+        self.n += 1
+        n = self.n
+        s, mean, m2, mn, mx = self.sum, self.mean, self.m2, self.min, self.max
+        for i, v in enumerate(vals):
+            s[i] += v
+            d = v - mean[i]
+            mean[i] += d / n
+            m2[i] += d * (v - mean[i])
+            if v < mn[i]:
+                mn[i] = v
+            if v > mx[i]:
+                mx[i] = v
+        if isinstance(valstats, ValStats):
+            stddev, multiplex = valstats.stddev, valstats.multiplex
+        else:
+            stddev = [x.stddev for x in valstats]
+            multiplex = [x.multiplex for x in valstats]
+        vs, sm = self.var_stddev, self.sum_multiplex
+        for i, (sd, m) in enumerate(itertools.izip(stddev, multiplex)):
+            vs[i] += sd * sd
+            sm[i] += m
+
+    def stddev(self, i):
+        if self.n < 2:
+            return 0.
+        return math.sqrt(self.m2[i] / (self.n - 1))
+
+    def valstats(self):
+        """Return ValStats for the sums."""
+        return ValStats(array.array('d', map(math.sqrt, self.var_stddev)),
+                        array.array('d', [x / self.n for x in self.sum_multiplex]))
+
+class QuantileSketch:
+    """Estimate quantiles of a stream of values with fixed memory.
+       Values are counted in logarithmic buckets, so the estimate is
+       within accuracy relative error. When there are more than
+       max_buckets the buckets closest to zero are merged."""
+    def __init__(self, accuracy=0.01, max_buckets=512):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.pos = Counter()
+        self.neg = Counter()
+        self.zero = 0
+        self.count = 0
+
+    def bucket(self, v):
+        return int(math.ceil(math.log(v) / self.log_gamma))
+
+    def add(self, v):
+        self.count += 1
+        if v > 1e-12:
+            b = self.pos
+            b[self.bucket(v)] += 1
+        elif v < -1e-12:
+            b = self.neg
+            b[self.bucket(-v)] += 1
+        else:
+            self.zero += 1
+            return
+        if len(b) > self.max_buckets:
+            self.trim(b)
+
+    def trim(self, b):
+        while len(b) > self.max_buckets:
+            k = sorted(b.keys())[:2]
+            b[k[1]] += b.pop(k[0])
+
+    def merge(self, other):
+        """Add the values counted in other, which must have the same accuracy."""
+        self.pos.update(other.pos)
+        self.neg.update(other.neg)
+        self.zero += other.zero
+        self.count += other.count
+        self.trim(self.pos)
+        self.trim(self.neg)
+
+    def value(self, k):
+        return 2 * self.gamma ** k / (self.gamma + 1)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return float('nan')
+        rank = q * (self.count - 1)
+        seen = 0
+        for k in sorted(self.neg.keys(), reverse=True):
+            seen += self.neg[k]
+            if seen > rank:
+                return -self.value(k)
+        seen += self.zero
+        if seen > rank:
+            return 0.
+        for k in sorted(self.pos.keys()):
+            seen += self.pos[k]
+            if seen > rank:
+                return self.value(k)
+        return self.value(max(self.pos.keys()))
+
 class ComputeStat:
     """Maintain statistics on measurement data."""
     def __init__(self, quiet):
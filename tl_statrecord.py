@@ -0,0 +1,221 @@
+# Copyright (c) 2017, Intel Corporation
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU General Public License,
+# version 2, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# Read the counts from "perf stat record" files.
+# parser/perfdata.py has the full description of the perf.data format,
+# but perf stat only writes a few flat records, so they are decoded
+# here with struct. This is much faster and doesn't need construct.
+# Handles both the normal file format (attributes and event names in the
+# header) and the pipe format (HEADER_ATTR and EVENT_UPDATE records).
+# Only works on Little-Endian with LE input files.
+import struct
+
+HEADER_ATTR = 64
+CPU_MAP = 74
+STAT_CONFIG = 75
+STAT = 76
+STAT_ROUND = 77
+EVENT_UPDATE = 78
+
+FEAT_EVENT_DESC = 12
+
+CPU_MAP_CPUS = 0
+CPU_MAP_MASK = 1
+CPU_MAP_RANGE = 2
+
+STAT_CONFIG_AGGR_MODE = 0
+STAT_CONFIG_INTERVAL = 1
+
+AGGR_NONE = 0
+AGGR_GLOBAL = 1
+AGGR_SOCKET = 2
+AGGR_CORE = 3
+AGGR_THREAD = 4
+
+ROUND_INTERVAL = 0
+ROUND_FINAL = 1
+
+EVENT_UPDATE_NAME = 2
+
+CHUNK = 1 << 20
+
+file_header = struct.Struct("=8sQQQQQQQQ32s")
+record_header = struct.Struct("=IHH")
+stat_record = struct.Struct("=QIIQQQ")
+
+class FormatError(Exception):
+    pass
+
+def is_stat_record(fn):
+    with open(fn, "rb") as f:
+        return f.read(8) in ("PERFILE2", "2ELIFREP")
+
+def cstring(s):
+    return s.split("\0", 1)[0]
+
+class StatRecord:
+    """A perf stat record file.
+       names has the event names in evlist order, cpus the cpu map,
+       aggr_mode and interval (in ms) the stat config of the recording."""
+    def __init__(self, fn):
+        self.f = open(fn, "rb")
+        self.ids = dict()
+        self.names = []
+        self.cpus = []
+        self.aggr_mode = AGGR_GLOBAL
+        self.interval = 0
+        h = self.f.read(16)
+        if len(h) < 16 or h[:8] not in ("PERFILE2", "2ELIFREP"):
+            raise FormatError("not a perf.data file")
+        if h[:8] != "PERFILE2":
+            raise FormatError("big endian perf.data files not supported")
+        size = struct.unpack("=Q", h[8:])[0]
+        if size == 16:
+            # pipe format, the events are described by records
+            self.data_left = None
+            return
+        self.f.seek(0)
+        (_, _, attr_size, attr_off, attr_len, data_off, data_len, _, _,
+            features) = file_header.unpack(self.f.read(file_header.size))
+        for i in range(attr_len / attr_size):
+            self.f.seek(attr_off + i * attr_size + attr_size - 16)
+            self.add_ids(i, *struct.unpack("=QQ", self.f.read(16)))
+            self.names.append("event%d" % i)
+        self.read_event_desc(features, data_off + data_len)
+        self.f.seek(data_off)
+        self.data_left = data_len
+
+    def add_ids(self, evsel, off, size):
+        self.f.seek(off)
+        for id in struct.unpack("=%dQ" % (size / 8), self.f.read(size)):
+            self.ids[id] = evsel
+
+    # the feature sections follow the data, one for every bit set
+    def read_event_desc(self, features, off):
+        bits = [ord(features[n / 8]) & (1 << (n % 8)) for n in range(FEAT_EVENT_DESC + 1)]
+        if not bits[FEAT_EVENT_DESC]:
+            return
+        self.f.seek(off + 16 * len(filter(None, bits[:FEAT_EVENT_DESC])))
+        off, size = struct.unpack("=QQ", self.f.read(16))
+        self.f.seek(off)
+        d = self.f.read(size)
+        nr, attr_size = struct.unpack_from("=II", d)
+        p = 8
+        for i in range(nr):
+            p += attr_size
+            nr_ids, l = struct.unpack_from("=II", d, p)
+            name = cstring(d[p + 8 : p + 8 + l])
+            p += 8 + l
+            ids = struct.unpack_from("=%dQ" % nr_ids, d, p)
+            p += 8 * nr_ids
+            evsel = self.ids[ids[0]] if ids and ids[0] in self.ids else i
+            if evsel < len(self.names):
+                self.names[evsel] = name
+
+    def read(self):
+        n = CHUNK
+        if self.data_left is not None:
+            n = min(n, self.data_left)
+            self.data_left -= n
+        return self.f.read(n) if n > 0 else ""
+
+    def records(self):
+        """Yield (type, buffer, start, end) for the records in the data."""
+        buf, off = "", 0
+        while True:
+            if len(buf) - off < record_header.size:
+                buf = buf[off:] + self.read()
+                off = 0
+                if len(buf) < record_header.size:
+                    break
+            typ, _, size = record_header.unpack_from(buf, off)
+            if size < record_header.size:
+                raise FormatError("corrupted record at %d" % (off,))
+            while len(buf) - off < size:
+                more = self.read()
+                if not more:
+                    raise FormatError("truncated file")
+                buf = buf[off:] + more
+                off = 0
+            yield typ, buf, off + record_header.size, off + size
+            off += size
+
+    # struct perf_record_cpu_map_data: u16 type, then a cpu list,
+    # a mask with unsigned longs aligned to long_size, or a range
+    def cpu_map(self, buf, p, end):
+        typ = struct.unpack_from("=H", buf, p)[0]
+        if typ == CPU_MAP_CPUS:
+            nr = struct.unpack_from("=H", buf, p + 2)[0]
+            self.cpus = list(struct.unpack_from("=%dH" % nr, buf, p + 4))
+        elif typ == CPU_MAP_MASK:
+            nr, long_size = struct.unpack_from("=HH", buf, p + 2)
+            if long_size not in (4, 8):
+                raise FormatError("cpu map with long size %d" % (long_size,))
+            start = p + 2 + long_size
+            mask = buf[start : start + nr * long_size]
+            self.cpus = [n for n in range(len(mask) * 8)
+                         if ord(mask[n / 8]) & (1 << (n % 8))]
+        elif typ == CPU_MAP_RANGE:
+            any_cpu, _, first, last = struct.unpack_from("=BBHH", buf, p + 2)
+            self.cpus = ([-1] if any_cpu else []) + range(first, last + 1)
+        else:
+            raise FormatError("unknown cpu map type %d" % (typ,))
+
+    def stat_config(self, buf, p):
+        nr = struct.unpack_from("=Q", buf, p)[0]
+        for tag, val in zip(*[iter(struct.unpack_from("=%dQ" % (2 * nr), buf, p + 8))] * 2):
+            if tag == STAT_CONFIG_AGGR_MODE:
+                self.aggr_mode = val
+            elif tag == STAT_CONFIG_INTERVAL:
+                self.interval = val
+
+    def header_attr(self, buf, p, end):
+        size = struct.unpack_from("=I", buf, p + 4)[0]
+        evsel = len(self.names)
+        self.names.append("event%d" % evsel)
+        n = (end - p - size) / 8
+        for id in struct.unpack_from("=%dQ" % n, buf, p + size):
+            self.ids[id] = evsel
+
+    def event_update(self, buf, p, end):
+        typ, id = struct.unpack_from("=QQ", buf, p)
+        if typ == EVENT_UPDATE_NAME and id in self.ids:
+            self.names[self.ids[id]] = cstring(buf[p + 16 : end])
+
+    def rounds(self):
+        """Yield (round type, time in ns, counts) for every round.
+           counts is a list of (event index, cpu index, thread, value,
+           enabled, running) in record order. The cpu index refers to
+           the cpu map of the event."""
+        counts = []
+        for typ, buf, p, end in self.records():
+            if typ == STAT:
+                id, cpu, thread, val, ena, run = stat_record.unpack_from(buf, p)
+                if id not in self.ids:
+                    raise FormatError("stat record for unknown id %d" % (id,))
+                counts.append((self.ids[id], cpu, thread, val, ena, run))
+            elif typ == STAT_ROUND:
+                rtype, time = struct.unpack_from("=QQ", buf, p)
+                yield rtype, time, counts
+                counts = []
+            elif typ == STAT_CONFIG:
+                self.stat_config(buf, p)
+            elif typ == CPU_MAP:
+                self.cpu_map(buf, p, end)
+            elif typ == HEADER_ATTR:
+                self.header_attr(buf, p, end)
+            elif typ == EVENT_UPDATE:
+                self.event_update(buf, p, end)
+        if counts:
+            yield ROUND_FINAL, None, counts
+
+    def close(self):
+        self.f.close()
@@ -4,6 +4,25 @@ from collections import defaultdict
 import csv
 import re
 
+def read_rows(f):
+    """Read the rows of a toplev output CSV file one by one.
+       Yield (ts, cpu, name, pct, state, helptxt, bn) for every row.
+       cpu is None without cpus, bn is True for the bottleneck.
+       Comments and other lines (like SUMMARY) are skipped."""
+    for r in csv.reader(f):
+        if len(r) < 5 or not re.match(r'\s*[0-9.]+$', r[0]):
+            continue
+        if len(r) >= 6 and re.match(r'[CS]\d+.*|\d+$', r[1]):
+            ts, cpu, name, pct, state, helptxt = r[0], r[1], r[2], r[3], r[4], r[5]
+        else:
+            ts, name, pct, state, helptxt = r[0], r[1], r[2], r[3], r[4]
+            cpu = None
+        try:
+            pct = float(pct.replace("%", ""))
+        except ValueError:
+            continue
+        yield float(ts), cpu, name, pct, state, helptxt, r[-1] == "<=="
+
 class TLData:
     """Read a toplev output CSV file.
 
@@ -34,19 +53,10 @@ class TLData:
         if self.mtime == mtime:
             return
         self.mtime = mtime
-        csvf = csv.reader(open(self.fn, 'r'))
         prevts = None
         val = dict()
-        for r in csvf:
-            if r[0].strip().startswith("#"):
-                continue
-            if re.match(r'[CS]\d+.*', r[1]):
-                ts, cpu, name, pct, state, helptxt = r[0], r[1], r[2], r[3], r[4], r[5]
-            else:
-                ts, name, pct, state, helptxt = r[0], r[1], r[2], r[3], r[4]
-                cpu = None
+        for ts, cpu, name, pct, state, helptxt, bn in read_rows(open(self.fn, 'r')):
             key = (name, cpu)
-            ts, pct = float(ts), float(pct.replace("%", ""))
             if name not in self.helptxt or self.helptxt[name] == "":
                 self.helptxt[name] = helptxt
             if state == "below" and not self.verbose:
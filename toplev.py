@@ -18,14 +18,22 @@
 # Handles a variety of perf and kernel versions, but older ones have various
 # limitations.
 
-import sys, os, re, itertools, textwrap, platform, pty, subprocess
-import exceptions, argparse, time, types, fnmatch, csv, copy
-from collections import defaultdict, Counter
+import sys, os, re, itertools, textwrap, platform, pty, subprocess, signal
+import exceptions, argparse, time, types, fnmatch, csv, array, hashlib, json, zlib, resource
+from collections import defaultdict, Counter, deque
 
-from tl_stat import combine_valstat, ComputeStat, ValStat
+from tl_stat import combine_valstat, combine_ref, ComputeStat, ValStats, RunningStats, QuantileSketch
 from tl_cpu import CPU
 import tl_output
+import tl_compile
+import tl_perfopen
+import tl_statrecord
+import tl_archive
+import tl_selfstats
+import tl_daemon
+import tl_prometheus
 import ocperf
+import event_download
 
 known_cpus = (
     ("snb", (42, )),
@@ -133,15 +141,80 @@ if not perf:
 def works(x):
     return os.system(x + " >/dev/null 2>/dev/null") == 0
 
-class PerfFeatures:
-    """Adapt to the quirks of various perf versions."""
+def which(prog):
+    if "/" in prog:
+        return prog
+    for d in os.getenv("PATH", "").split(":"):
+        fn = os.path.join(d, prog)
+        if os.access(fn, os.X_OK):
+            return fn
+    return None
+
+perf_probes = {
+    "logfd": " stat --log-fd 3 3>/dev/null true",
+    # problem in 4.12. fixed in v4.14, suppresses duplicate events
+    "nomerge": " stat --no-merge true",
+}
+
+class PerfFeatures(object):
+    """Adapt to the quirks of various perf versions.
+       perf is only run when a feature is first needed. Supported features
+       are cached per perf binary and kernel in ~/.cache/pmu-events.
+       Failures are probed again, they can have other reasons than the
+       perf version, like perf_event_paranoid."""
     def __init__(self):
-        self.logfd_supported = works(perf + " stat --log-fd 3 3>/dev/null true")
-        if not self.logfd_supported:
-            sys.exit("perf binary is too old. please upgrade")
-        self.supports_power = works(perf + " list  | grep -q power/")
-        # problem in 4.12. fixed in v4.14, suppresses duplicate events
-        self.supports_nomerge = works(perf + " stat --no-merge true")
+        self.features = None
+        self.fn = None
+
+    def cache_file(self):
+        fn = which(perf)
+        if not fn:
+            return None
+        st = os.stat(fn)
+        key = [os.path.abspath(fn), st.st_size, st.st_mtime, os.uname()[2]]
+        return "%s/toplev-perf-%s.json" % (event_download.getdir(),
+                hashlib.sha1(json.dumps(key)).hexdigest())
+
+    def load(self):
+        self.features = dict()
+        try:
+            self.fn = self.cache_file()
+            with open(self.fn, "r") as f:
+                self.features = dict([(k, v) for k, v in json.load(f).items() if v])
+        except Exception:
+            pass
+
+    def save(self):
+        if not self.fn:
+            return
+        tmp = "%s.%d" % (self.fn, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                json.dump(dict([(k, v) for k, v in self.features.items() if v]), f)
+            os.rename(tmp, self.fn)
+        except (IOError, OSError):
+            pass
+
+    def probe(self, name):
+        if self.features is None:
+            self.load()
+        if name not in self.features:
+            self.features[name] = works(perf + perf_probes[name])
+            if self.features[name]:
+                self.save()
+        return self.features[name]
+
+    @property
+    def logfd_supported(self):
+        return self.probe("logfd")
+
+    @property
+    def supports_nomerge(self):
+        return self.probe("nomerge")
+
+    @property
+    def supports_power(self):
+        return os.path.isdir("/sys/bus/event_source/devices/power")
 
 def kv_to_key(v):
     return v[0] * 100 + v[1]
@@ -207,9 +280,12 @@ def needed_counters(evlist):
 
     return num
 
+def is_group(evlist):
+    return not args.no_group and 1 < needed_counters(evlist) <= cpu.counters
+
 def event_group(evlist):
     e = ",".join(add_filter(evlist))
-    if not args.no_group and 1 < needed_counters(evlist) <= cpu.counters:
+    if is_group(evlist):
         e = "{%s}" % (e,)
     return e
 
@@ -284,7 +360,30 @@ g.add_argument('--no-multiplex',
                action='store_true')
 g.add_argument('--single-thread', '-S', help='Measure workload as single thread. Workload must run single threaded. In SMT mode other thread must be idle.', action='store_true')
 g.add_argument('--fast', '-F', help='Skip sanity checks to optimize CPU consumption', action='store_true')
-g.add_argument('--import', help='Import specified perf stat output file instead of running perf')
+g.add_argument('--import', help='Import specified perf stat output file or perf stat record file instead of running perf')
+g.add_argument('--collector', help='How to count the events: run perf, or open them directly '
+               'with perf_event_open', choices=['perf', 'direct'], default='perf')
+g.add_argument('--scheduler', help='Algorithm to assign events to groups. pack uses less groups, '
+               'which means less multiplexing', choices=['first-fit', 'pack'], default='first-fit')
+g.add_argument('--daemon', help='With -I keep the results of the last intervals in memory and answer '
+               'queries on the unix socket SOCKET instead of printing them. All nodes are kept, '
+               'the nodes below threshold are marked below',
+               metavar='SOCKET')
+g.add_argument('--daemon-intervals', help='Number of intervals kept by --daemon', type=int, default=3600)
+g.add_argument('--prometheus', help='Serve the results of the last interval for Prometheus on [HOST:]PORT '
+               'instead of printing them. Needs -I', metavar='PORT')
+g.add_argument('--prometheus-aggregate', help='Aggregate the cpus of the Prometheus results to cores, '
+               'sockets or none. auto aggregates so that there are no more than --prometheus-max-cpus',
+               choices=['auto', 'cpu', 'core', 'socket', 'none'], default='auto')
+g.add_argument('--prometheus-max-cpus', help='Maximum number of cpu label values for '
+               '--prometheus-aggregate auto', type=int, default=64)
+g.add_argument('--overhead-budget', help='With -I keep the CPU time of toplev below PCT percent of a CPU. '
+               'Widens the interval, disables metrics or lowers the level when over the budget, and goes '
+               'back when under. toplev runs the workload itself', type=float, metavar='PCT')
+g.add_argument('--drilldown', help='With -I start measuring level 1 only. Every N intervals restart '
+               'measuring only the subtree of the main bottleneck (upto --level), then level 1 again. '
+               'Gives more counter time to each node. toplev runs the workload itself',
+               type=int, metavar='N')
 
 g = p.add_argument_group('Measurement filtering')
 g.add_argument('--kernel', help='Only measure kernel code', action='store_true')
@@ -312,6 +411,12 @@ g = p.add_argument_group('Workarounds')
 g.add_argument('--no-group', help='Dont use groups', action='store_true')
 g.add_argument('--force-events', help='Assume kernel supports all events. May give wrong results.', action='store_true')
 g.add_argument('--ignore-errata', help='Do not disable events with errata', action='store_true')
+g.add_argument('--no-compile', help='Compute each node separately instead of using the compiled model',
+               action='store_true')
+g.add_argument('--no-schedule-cache', help='Do not cache the event group schedule in ~/.cache/pmu-events',
+               action='store_true')
+g.add_argument('--no-lazy', help='Compute all nodes, not only the children of nodes above threshold',
+               action='store_true')
 
 g = p.add_argument_group('Output')
 g.add_argument('--no-desc', help='Do not print event descriptions', action='store_true')
@@ -330,6 +435,8 @@ g.add_argument('--long-desc', help='Print long descriptions instead of abbreviat
                 action='store_true')
 g.add_argument('--columns', help='Print CPU output in multiple columns', action='store_true')
 g.add_argument('--summary', help='Print summary at the end. Only useful with -I', action='store_true')
+g.add_argument('--summary-percentiles', help='Also print p50/p95/p99 of the node values over all intervals with --summary',
+               action='store_true')
 g.add_argument('--perf-output', help='Save perf stat output in specified file', type=argparse.FileType('w'))
 
 g = p.add_argument_group('Additional information')
@@ -337,7 +444,13 @@ g.add_argument('--print-group', '-g', help='Print event group assignments',
                action='store_true')
 g.add_argument('--raw', help="Print raw values", action='store_true')
 g.add_argument('--valcsv', '-V', help='Write raw counter values into CSV file', type=argparse.FileType('w'))
+g.add_argument('--raw-archive', help='Write raw counter values into a compact binary archive. Can be read back with --import',
+               type=argparse.FileType('wb'))
+g.add_argument('--archive-compress', help='zlib compression level for --raw-archive. 0 for none', type=int, default=1)
 g.add_argument('--stats', help='Show statistics on what events counted', action='store_true')
+g.add_argument('--self-stats', help='Measure the overhead of toplev itself. Write the time of the processing '
+               'phases, CPU time, memory and event rates of every interval as CSV into specified file, '
+               'and print a summary at the end', type=argparse.FileType('w'), metavar='FILE')
 g.add_argument('--detailed', '-d', help=argparse.SUPPRESS, action='store_true')
 
 g = p.add_argument_group('Sampling')
@@ -350,6 +463,7 @@ g.add_argument('--sample-basename', help='Base name of sample perf.data files',
 p.add_argument('--version', help=argparse.SUPPRESS, action='store_true')
 p.add_argument('--debug', help=argparse.SUPPRESS, action='store_true')
 p.add_argument('--repl', action='store_true', help=argparse.SUPPRESS)
+p.add_argument('--check-compile', action='store_true', help=argparse.SUPPRESS)
 args, rest = p.parse_known_args()
 
 rest = [x for x in rest if x != "--"]
@@ -393,8 +507,31 @@ if args.graph:
 if args.sample_repeat:
     args.run_sample = True
 
+if args.drilldown:
+    if not args.interval:
+        sys.exit("--drilldown needs -I")
+    if args.no_multiplex or args.__dict__['import'] or args.collector != 'perf':
+        sys.exit("--drilldown is not supported with --no-multiplex, --import or --collector direct")
+
+if args.daemon and not args.interval:
+    sys.exit("--daemon needs -I")
+
+if args.prometheus and (not args.interval or args.daemon):
+    sys.exit("--prometheus needs -I and does not work with --daemon")
+
+if args.overhead_budget:
+    if not args.interval:
+        sys.exit("--overhead-budget needs -I")
+    if args.no_multiplex or args.__dict__['import'] or args.collector != 'perf' or args.drilldown:
+        sys.exit("--overhead-budget is not supported with --no-multiplex, --import, "
+                 "--collector direct or --drilldown")
+
 print_all = args.verbose # or args.csv
 dont_hide = args.verbose
+if args.prometheus or args.daemon:
+    # keep the set of series stable between scrapes and queries, the
+    # thresholds are exported separately
+    print_all = dont_hide = True
 detailed_model = (args.level > 1) or args.detailed
 csv_mode = args.csv
 interval_mode = args.interval
@@ -447,6 +584,10 @@ class PerfRun:
             ret = self.perf.wait()
         return ret
 
+    def stop(self):
+        if self.perf and self.perf.poll() is None:
+            self.perf.send_signal(signal.SIGINT)
+
 fixed_counters = {
     "CPU_CLK_UNHALTED.THREAD": "cycles",
     "CPU_CLK_UNHALTED.THREAD:amt1": "cpu/event=0x3c,umask=0x0,any=1/",
@@ -479,27 +620,36 @@ def add_filter(s):
     return s
 
 notfound_cache = set()
+raw_cache = dict()
 
 def raw_event(i, name="", period=False):
+    k = (i, name, period)
+    if k not in raw_cache:
+        raw_cache[k] = do_raw_event(i, name, period)
+    return raw_cache[k]
+
+def do_raw_event(i, name, period):
     orig_i = i
     if "." in i or "_" in i:
         if i in fixed_counters:
             return fixed_counters[i]
-        e = emap.getevent(i)
-        if e is None:
+        r = emap.resolve_event(i)
+        if r is None:
             if i in event_fixes:
-                e = emap.getevent(event_fixes[i])
-        if e is None:
+                r = emap.resolve_event(event_fixes[i])
+        if r is None:
             if i not in notfound_cache:
                 notfound_cache.add(i)
                 print >>sys.stderr, "%s not found" % (i,)
             return "dummy"
+        e = r.event
         oi = i
-        i = e.output(noname=True, name=name, period=period)
+        i = r.perf
+        if name or period:
+            i = e.output(noname=True, name=name, period=period)
         if len(re.findall(r'[a-z0-9_]+/.*?/[a-z]*', i)) > 1:
             print "Event", oi, "maps to multiple units. Ignored."
             return "dummy" # FIXME
-        emap.update_event(e.output(noname=True), e)
         # next three things should be moved somewhere else
         if i.startswith("uncore"):
             outgroup_events.add(i)
@@ -551,6 +701,8 @@ def print_header(work, evlist):
           " [%d counters]" % (needed_counters(raw_events(evnames))), 75, "  ")
 
 def perf_args(evstr, rest):
+    if not feat.logfd_supported:
+        sys.exit("perf binary is too old. please upgrade")
     add = []
     if interval_mode:
         add += ['-I', str(interval_mode)]
@@ -585,26 +737,32 @@ def print_account(ad):
         print >>sys.stderr, ", ".join(["%d events %s" % (num, e) for e, num in total.iteritems()])
 
 class ValidEvents:
-    def update(self):
-        self.string = "|".join(self.valid_events)
+    """Recognize event fields in perf output.
+       Model events are looked up by exact name, the generic perf event
+       formats by a fixed set of prefix patterns."""
+    generic = re.compile(r"cpu/.*?/|uncore.*?/.*?/|ref-cycles|r[0-9a-fA-F]+|cycles|instructions|dummy")
 
     def __init__(self):
-        self.valid_events = [r"cpu/.*?/", "uncore.*?/.*?/", "ref-cycles",
-                             r"r[0-9a-fA-F]+", "cycles", "instructions", "dummy"]
-        self.update()
+        self.valid_events = set()
 
     def add_event(self, ev):
-        # add first to overwrite more generic regexprs list r...
-        self.valid_events.insert(0, ev)
-        self.update()
+        self.valid_events.add(ev)
+
+    def match(self, ev):
+        if ev in self.valid_events:
+            return True
+        # perf echos back ring filter qualifiers, like cs:k
+        n = ev.rfind(":")
+        if n > 0 and ev[:n] in self.valid_events:
+            return True
+        return self.generic.match(ev) is not None
 
 valid_events = ValidEvents()
 
 def is_event(l, n):
     if len(l) <= n:
         return False
-    # use static string to make regexpr caching work
-    return re.match(valid_events.string, l[n])
+    return valid_events.match(l[n])
 
 def is_number(n):
     return re.match(r'\d+', n) is not None
@@ -618,6 +776,9 @@ def key_to_coreid(k):
     x = cpu.cputocore[int(k)]
     return x[0] * 1000 + x[1]
 
+# result keys of the threads of every core
+core_keys = dict([(k[0] * 1000 + k[1], ["%d" % x for x in l]) for k, l in cpu.coreids.items()])
+
 def core_fmt(core):
     if cpu.sockets > 1:
         return "S%d-C%d" % (core / 1000, core % 1000,)
@@ -654,52 +815,72 @@ def display_keys(runner, keys):
         all_cpus += ["S%d" % x for x in range(cpu.sockets)]
     return all_cpus
 
-def print_keys(runner, res, rev, valstats, out, interval, env):
+def print_keys(runner, res, rev, valstats, out, interval, env, summary=None):
     stat = runner.stat
+    def sketch(title, match):
+        if summary:
+            summary.add_nodes(title, runner.olist, match)
     out.set_cpus(display_keys(runner, res.keys()))
     if smt_mode:
         printed_cores = set()
+        core_state = dict()
         for j in sorted(res.keys()):
             if j != "" and int(j) not in runner.allowed_threads:
                 continue
 
-            runner.reset_thresh()
-
-            # collect counts from all threads of cores as lists
-            # this way the model can access all threads individually
+            # the core nodes are computed once with the first thread of
+            # the core, the other threads reuse them
             core = key_to_coreid(j)
-            cpus = [x for x in res.keys() if key_to_coreid(x) == core]
-            combined_res = zip(*[res[x] for x in cpus])
-            st = [combine_valstat(z) for z in itertools.izip(*[valstats[x] for x in cpus])]
-
-            # repeat a few times to get stable threshold values
-            # in case of mutual dependencies between SMT and non SMT
-            # XXX use better algorithm
-            used_stat = stat
-            for _ in range(3):
-                runner.compute(res[j], rev[j], valstats[j], env, thread_node, used_stat)
-                runner.compute(combined_res, rev[cpus[0]], st, env, core_node, used_stat)
-                used_stat = None
+            first = core not in printed_cores
+            if first:
+                # collect counts from all threads of cores as lists
+                # this way the model can access all threads individually
+                cpus = [x for x in core_keys[core] if x in res]
+                combined_res = zip(*[res[x] for x in cpus])
+                st = [combine_valstat(z) for z in itertools.izip(*[valstats[x] for x in cpus])]
+
+            # thread and core nodes depend on each other, compute them
+            # in dependency order
+            for n, (tmatch, cmatch, written) in enumerate(runner.smt_matches()):
+                if tmatch:
+                    runner.compute_nodes(res[j], rev[j], valstats[j], env, tmatch, stat)
+                if not cmatch:
+                    continue
+                if first:
+                    runner.compute_nodes(combined_res, rev[cpus[0]], st, env, cmatch, stat)
+                    core_state[core, n] = runner.save_nodes(written)
+                else:
+                    runner.load_nodes(core_state[core, n])
+            runner.propagate_smt_siblings()
 
             # find bottleneck
             bn = find_bn(runner.olist, not_package_node)
+            if bn and runner.bottlenecks is not None:
+                runner.bottlenecks[bn] += 1
 
             # print the SMT aware nodes
-            if core not in printed_cores:
+            if first:
                 runner.print_res(out, interval, core_fmt(core), core_node, bn)
+                sketch(core_fmt(core), core_node)
                 printed_cores.add(core)
 
             # print the non SMT nodes
             # recompute the nodes so we get up-to-date values
             runner.print_res(out, interval, thread_fmt(j), thread_node, bn)
+            sketch(thread_fmt(j), thread_node)
     else:
-        for j in sorted(res.keys()):
-            if j != "" and is_number(j) and int(j) not in runner.allowed_threads:
-                continue
-            runner.compute(res[j], rev[j], valstats[j], env, not_package_node, stat)
-            bn = find_bn(runner.olist, not_package_node)
+        keys = [j for j in sorted(res.keys())
+                if j == "" or not is_number(j) or int(j) in runner.allowed_threads]
+        m = runner.compute_keys(keys, res, rev, valstats, env, not_package_node, stat)
+        for j, (row, bn) in zip(keys, m):
+            if bn and runner.bottlenecks is not None:
+                runner.bottlenecks[bn] += 1
+            runner.load_row(row)
             runner.print_res(out, interval, j, not_package_node, bn)
+            sketch(j, not_package_node)
     packages = set()
+    keys = []
+    names = []
     for j in sorted(res.keys()):
         if j == "":
             continue
@@ -713,24 +894,74 @@ def print_keys(runner, res, rev, valstats, out, interval, env):
             jname = "S%d" % p_id
         else:
             jname = j
-        runner.compute(res[j], rev[j], valstats[j], env, package_node, stat)
+        keys.append(j)
+        names.append(jname)
+    # no bottlenecks from package nodes for now
+    m = runner.compute_keys(keys, res, rev, valstats, env, package_node, stat)
+    for jname, (row, bn) in zip(names, m):
+        runner.load_row(row)
         runner.print_res(out, interval, jname, package_node, None)
-        # no bottlenecks from package nodes for now
+        sketch(jname, package_node)
     out.flush()
     stat.referenced_check(res)
     stat.compute_errors()
 
+def archive_groups(runner, n):
+    gnums = group_numbers(filter(lambda x: len(x) > 0, runner.evgroups))
+    if len(gnums) != n:
+        return None
+    return gnums
+
 def print_and_sum_keys(runner, res, rev, valstats, out, interval, env):
+    if runner.archive:
+        runner.archive.write(interval if interval_mode else env.get('interval-s', 0.),
+                             res, rev, valstats,
+                             lambda n: archive_groups(runner, n))
     if runner.summary:
 	runner.summary.add(res, rev, valstats, env);
-    print_keys(runner, res, rev, valstats, out, interval, env)
+    print_keys(runner, res, rev, valstats, out, interval, env, runner.summary)
+    if runner.selfstats:
+        runner.selfstats.interval(interval if interval_mode else "",
+                                  sum([len(x) for x in res.values()]))
 
 def print_summary(runner, out):
-    if not args.summary:
+    if not args.summary or runner.summary.intervals == 0:
         return
-    print_keys(runner, runner.summary.res, runner.summary.rev,
-	       runner.summary.valstats, out,
-	       float('nan'), runner.summary.env)
+    summary = runner.summary
+    res, rev, valstats = summary.results()
+    print_keys(runner, res, rev, valstats, out,
+	       float('nan'), summary.env)
+    if args.raw:
+        for j in sorted(summary.stats.keys()):
+            st = summary.stats[j]
+            for i, ev in enumerate(rev[j]):
+                print "raw summary", j, "event", ev, "sum", st.sum[i], "mean", st.mean[i], \
+                      "stddev", st.stddev(i), "min", st.min[i], "max", st.max[i]
+    if summary.sketches:
+        print_percentiles(runner, out, summary)
+
+def print_percentiles(runner, out, summary):
+    quantiles = (0.5, 0.95, 0.99)
+    if csv_mode:
+        out.logf.write(csv_mode.join(["Title", "Node"] +
+                                     ["p%d" % (q * 100) for q in quantiles]) + "\n")
+    else:
+        out.logf.write("Percentiles over %d intervals:\n" % (summary.intervals,))
+    for title in sorted(summary.sketches.keys()):
+        sk = summary.sketches[title]
+        for o in runner.olist:
+            if o.name not in sk:
+                continue
+            # like print_res, ratios are printed as percent
+            scale = 1.0 if o.metric else 100.0
+            vals = [sk[o.name].quantile(q) * scale for q in quantiles]
+            name = o.name if o.metric else full_name(o)
+            if csv_mode:
+                out.logf.write(csv_mode.join([title, name] +
+                                             ["%.2f" % v for v in vals]) + "\n")
+            else:
+                out.logf.write("%-8s %-50s %s\n" % (title, name,
+                    " ".join(["p%d %8.2f" % (q * 100, v) for q, v in zip(quantiles, vals)])))
 
 def is_outgroup(x):
     return set(x) - outgroup_events == set()
@@ -748,49 +979,329 @@ class SaveContext:
         if self.startoffset is not None:
             sys.stdin.seek(self.startoffset)
 
+# plan the runs for --no-multiplex
+# merge the groups into as few runs as possible. each run measures
+# the union of its groups as a single group that fits into the counters.
+# outgroup groups run together with the group following them.
+def plan_runs(groups):
+    runs = []
+    run_of = dict()
+    for g in sorted([x for x in groups if not is_outgroup(x)],
+                    key=lambda x: -needed_counters(x)):
+        evset = set(g)
+        best = None
+        for r in runs:
+            n = needed_counters(r[0] | evset)
+            if n <= cpu.counters:
+                cost = (n - needed_counters(r[0]), -n)
+                if best is None or cost < best[0]:
+                    best = (cost, r)
+        if best:
+            r = best[1]
+        else:
+            r = [set(), [], []]
+            runs.append(r)
+        r[0] |= evset
+        for e in g:
+            if e not in r[1]:
+                r[1].append(e)
+        run_of[id(g)] = r
+    outg = []
+    for g in groups:
+        if is_outgroup(g):
+            outg.append(g)
+        elif outg:
+            run_of[id(g)][2] += outg
+            outg = []
+    if outg:
+        if not runs:
+            runs.append([set(), [], []])
+        runs[-1][2] += outg
+    return [r[2] + ([r[1]] if r[1] else []) for r in runs]
+
 def execute_no_multiplex(runner, out, rest):
     if args.interval: # XXX
         sys.exit('--no-multiplex is not supported with interval mode')
-    res = defaultdict(list)
-    rev = defaultdict(list)
-    valstats = defaultdict(list)
     env = dict()
     groups = [x for x in runner.evgroups if len(x) > 0]
-    num_runs = len(groups) - count(is_outgroup, groups)
-    outg = []
-    n = 0
+    runs = plan_runs(groups)
+    print "%d runs needed for %d groups" % (len(runs), len(groups))
+    # results by cpu and event
+    results = defaultdict(dict)
     ctx = SaveContext()
-    # runs could be further reduced by tweaking
-    # the scheduler to avoid any duplicated events
-    for g in groups:
-        if is_outgroup(g):
-            outg.append(g)
-            continue
-        n += 1
-        print "RUN #%d of %d" % (n, num_runs)
-        ret, res, rev, interval, valstats = do_execute(runner, outg + [g], out, rest,
-                                                 res, rev, valstats, env)
+    for n, run in enumerate(runs):
+        print "RUN #%d of %d" % (n + 1, len(runs))
+        rs = ResultStore()
+        ret, interval = do_execute(runner, run, out, rest, rs, env)
         ctx.restore()
-        outg = []
-    assert num_runs == n
-    print_and_sum_keys(runner, res, rev, valstats, out, interval, env)
+        evl = list(flatten(run))
+        for title in rs.res.keys():
+            for r in zip(evl, rs.rev[title], rs.res[title],
+                         rs.stddev[title], rs.multiplex[title]):
+                results[title][r[0]] = r[1:]
+    # put them back into the order expected by the result maps
+    store = ResultStore()
+    for title in results.keys():
+        for ev in runner.evnum:
+            if ev in results[title]:
+                store.add(title, *results[title][ev])
+            else:
+                store.add(title, ev, 0., 0., 0.)
+    store.finish()
+    print_and_sum_keys(runner, store.res, store.rev, store.valstats, out, interval, env)
     return ret
 
 def execute(runner, out, rest):
     env = dict()
     events = filter(lambda x: len(x) > 0, runner.evgroups)
     ctx = SaveContext()
-    ret, res, rev, interval, valstats = do_execute(runner, events,
-                                         out, rest,
-                                         defaultdict(list),
-                                         defaultdict(list),
-                                         defaultdict(list),
-                                         env)
+    store = ResultStore()
+    ret, interval = do_execute(runner, events, out, rest, store, env)
     ctx.restore()
-    print_and_sum_keys(runner, res, rev, valstats, out, interval, env)
+    print_and_sum_keys(runner, store.res, store.rev, store.valstats, out, interval, env)
     return ret
 
-def group_number(num, events):
+def is_ancestor(a, obj):
+    obj = getattr(obj, 'parent', None)
+    while obj:
+        if obj is a:
+            return True
+        obj = getattr(obj, 'parent', None)
+    return False
+
+# add the nodes that the nodes in want use, so that they
+# compute the same way as with the full tree.
+def used_nodes(olist, want):
+    nodes = dict([(id(o), o) for o in olist])
+    wanted = set(map(id, want))
+    todo = list(want)
+    while todo:
+        obj = todo.pop()
+        for k, v in obj.__dict__.items():
+            if k != 'sibling' and id(v) in nodes and id(v) not in wanted:
+                wanted.add(id(v))
+                todo.append(v)
+    return [o for o in olist if id(o) in wanted]
+
+# the nodes measured in a --drilldown phase: level 1, or the subtree
+# of root with its parents.
+def drill_nodes(olist, root):
+    if root is None:
+        want = [o for o in olist if o.metric or o.level == 1]
+    else:
+        want = [o for o in olist if o.metric or o is root or
+                is_ancestor(root, o) or is_ancestor(o, root)]
+    return used_nodes(olist, want)
+
+class DrillPhase:
+    """A collection phase of up to intervals intervals (no limit when None).
+       start is the time offset of the phase."""
+    def __init__(self, root, intervals, start):
+        self.root = root
+        self.intervals = intervals
+        self.start = start
+        self.end = start
+        self.count = 0
+        self.stopped = False
+        self.finished = False
+        self.prun = None
+
+    def next_interval(self):
+        """Called when an interval is complete. Return True to end the phase."""
+        if self.count == self.intervals:
+            return True
+        self.count += 1
+        return False
+
+class Drilldown:
+    """Phases of --drilldown: level 1, then the subtree of the main bottleneck."""
+    name = "--drilldown"
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.full = runner.olist
+        self.root = None
+
+    def start_phase(self, start):
+        self.runner.select_nodes(drill_nodes(self.full, self.root))
+        self.runner.bottlenecks.clear()
+        return DrillPhase(self.root, args.drilldown, start)
+
+    def end_phase(self, phase, out):
+        runner = self.runner
+        if not args.quiet:
+            print "Drilldown measured %s from %.2fs to %.2fs" % (
+                    full_name(self.root) if self.root else "level 1", phase.start, phase.end)
+        # the counts of different phases cannot be summed
+        if runner.summary:
+            print_summary(runner, out)
+            runner.summary = Summary(args.summary_percentiles)
+        # go down into the main bottleneck when its children were not
+        # measured yet, otherwise back to level 1
+        bn = runner.bottlenecks.most_common(1)
+        self.root = None
+        if bn and any([is_ancestor(bn[0][0], o) for o in self.full if o not in runner.olist]):
+            self.root = bn[0][0]
+
+# how often the interval can be doubled by --overhead-budget
+GOVERNOR_WIDEN = 3
+# number of intervals the overhead is averaged over
+GOVERNOR_WINDOW = 5
+# go back to the previous setting when below this fraction of the budget
+GOVERNOR_RESTORE = 0.5
+
+class GovernorPhase(DrillPhase):
+    """A --overhead-budget phase. Ends when the governor wants other settings."""
+    def __init__(self, governor, start):
+        DrillPhase.__init__(self, None, None, start)
+        self.governor = governor
+        self.samples = deque(maxlen=GOVERNOR_WINDOW)
+        self.last = None
+
+    def next_interval(self):
+        now = time.time()
+        cpu = tl_selfstats.cputime(resource.getrusage(resource.RUSAGE_SELF))
+        self.count += 1
+        # the first interval includes the startup, so start after it
+        if self.last:
+            self.samples.append((now - self.last[0], cpu - self.last[1]))
+        self.last = (now, cpu)
+        if len(self.samples) < GOVERNOR_WINDOW:
+            return False
+        wall = sum([x[0] for x in self.samples])
+        cpu = sum([x[1] for x in self.samples])
+        return self.governor.check(100. * cpu / wall if wall > 0 else 0.)
+
+# the settings of --overhead-budget, from the most to the least expensive:
+# wider intervals, no metrics, lower levels.
+def governor_settings(interval, level, metrics):
+    l = [(interval, level, metrics)]
+    for j in range(GOVERNOR_WIDEN):
+        interval *= 2
+        l.append((interval, level, metrics))
+    if metrics:
+        metrics = False
+        l.append((interval, level, metrics))
+    while level > 1:
+        level -= 1
+        l.append((interval, level, metrics))
+    return l
+
+def governor_nodes(olist, level, metrics):
+    return used_nodes(olist, [o for o in olist if
+                              (metrics if o.metric else o.level <= level)])
+
+class Governor:
+    """Phases of --overhead-budget: measure the CPU time of toplev, and switch
+       to cheaper settings when over the budget, or back when well under it."""
+    name = "--overhead-budget"
+
+    def __init__(self, runner, budget):
+        self.runner = runner
+        self.full = runner.olist
+        self.budget = budget
+        self.settings = governor_settings(interval_mode,
+                max([o.level for o in self.full if not o.metric] + [1]),
+                any([o.metric for o in self.full]))
+        self.cur = self.next = 0
+        self.overhead = 0.
+        self.warned = False
+
+    def check(self, overhead):
+        self.overhead = overhead
+        if overhead > self.budget:
+            if self.cur + 1 < len(self.settings):
+                self.next = self.cur + 1
+                return True
+            if not self.warned:
+                print >>sys.stderr, "toplev overhead %.2f%% over budget with the cheapest settings" % (
+                        overhead)
+                self.warned = True
+        elif overhead < self.budget * GOVERNOR_RESTORE and self.cur > 0:
+            self.next = self.cur - 1
+            return True
+        return False
+
+    def start_phase(self, start):
+        global interval_mode
+        interval_mode, level, metrics = self.settings[self.cur]
+        olist = governor_nodes(self.full, level, metrics)
+        if olist != self.runner.olist:
+            self.runner.select_nodes(olist)
+        return GovernorPhase(self, start)
+
+    def end_phase(self, phase, out):
+        if not phase.stopped:
+            return
+        old, new = self.settings[self.cur], self.settings[self.next]
+        out.note("%.9f toplev overhead %.2f%% %s budget %.2f%%, now interval %dms level %d metrics %s" % (
+                 phase.end, self.overhead, "over" if self.next > self.cur else "under",
+                 self.budget, new[0], new[1], "on" if new[2] else "off"))
+        # the counts of different nodes cannot be summed
+        if old[1:] != new[1:] and self.runner.summary:
+            print_summary(self.runner, out)
+            self.runner.summary = Summary(args.summary_percentiles)
+        self.cur = self.next
+
+# split perf arguments into options and workload
+perf_arg_options = frozenset(["-e", "--event", "-C", "--cpu", "-p", "--pid",
+    "-t", "--tid", "-G", "--cgroup", "-r", "--repeat", "-o", "--output",
+    "-x", "--field-separator", "-D", "--delay", "-I", "--interval-print",
+    "--pre", "--post", "--log-fd", "-M", "--metrics"])
+
+def split_workload(rest):
+    i = 0
+    while i < len(rest) and rest[i].startswith("-"):
+        if rest[i] in perf_arg_options:
+            i += 1
+        i += 1
+    return rest[:i], rest[i:]
+
+# Measure in phases with different settings, and restart perf between them.
+# policy selects the settings of every phase.
+# The workload runs for all phases, so toplev starts it and perf only
+# attaches to it, or measures the whole system.
+def execute_phases(runner, out, rest, policy):
+    opts, cmd = split_workload(rest)
+    attached = set(opts) & set(["-a", "--all-cpus", "-C", "--cpu", "-p", "--pid", "-t", "--tid"])
+    if not cmd and not attached:
+        sys.exit("%s needs a workload, -a or -p" % policy.name)
+    child = None
+    if cmd:
+        child = subprocess.Popen(cmd)
+        if not attached:
+            opts = opts + ["--pid", "%d" % child.pid]
+    cur = [None]
+    def workload_exit(signum, frame):
+        if child.poll() is not None and cur[0]:
+            cur[0].finished = True
+            if cur[0].prun:
+                cur[0].prun.stop()
+    if child:
+        signal.signal(signal.SIGCHLD, workload_exit)
+        signal.siginterrupt(signal.SIGCHLD, False)
+    full = runner.olist
+    start = time.time()
+    ret = 0
+    env = dict()
+    while child is None or child.poll() is None:
+        phase = cur[0] = policy.start_phase(time.time() - start)
+        store = ResultStore()
+        ret, interval = do_execute(runner, filter(lambda x: len(x) > 0, runner.evgroups),
+                                   out, opts, store, env, phase)
+        if not store.empty():
+            print_and_sum_keys(runner, store.res, store.rev, store.valstats, out, interval, env)
+        policy.end_phase(phase, out)
+        if not phase.stopped:
+            break
+    if child:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        ret = child.wait()
+    if runner.olist is not full:
+        runner.select_nodes(full)
+    return ret
+
+def group_numbers(events):
     gnum = itertools.count(1)
     def group_nums(group):
         if all([x in outgroup_events for x in group]):
@@ -800,7 +1311,14 @@ def group_number(num, events):
         return [idx] * len(group)
 
     gnums = map(group_nums, events)
-    return list(flatten(gnums))[num]
+    return list(flatten(gnums))
+
+gnum_cache = [None, None]
+
+def group_number(num, events):
+    if gnum_cache[0] is not events:
+        gnum_cache[:] = [events, group_numbers(events)]
+    return gnum_cache[1][num]
 
 def dump_raw(interval, title, event, val, index, events, stddev, multiplex):
     if event in fixed_to_name:
@@ -822,19 +1340,123 @@ perf_fields = [
     r"Joules",
     ""]
 
-def do_execute(runner, events, out, rest, res, rev, valstats, env):
+class ResultStore:
+    """Counter values of one measurement, indexed by cpu and event index.
+       res, rev and valstats present the usual per cpu views.
+       The arrays are allocated on the first interval and overwritten
+       in place for the following ones. All cpus share one event name
+       list as long as perf reports them in the same order."""
+    def __init__(self):
+        self.res = dict()
+        self.rev = dict()
+        self.valstats = dict()
+        self.stddev = dict()
+        self.multiplex = dict()
+        self.events = []
+        self.fill = Counter()
+
+    def add(self, title, event, val, stddev, multiplex):
+        if title not in self.res:
+            self.res[title] = array.array('d')
+            self.stddev[title] = array.array('d')
+            self.multiplex[title] = array.array('d')
+            self.valstats[title] = ValStats(self.stddev[title], self.multiplex[title])
+            self.rev[title] = self.events
+        i = self.fill[title]
+        vals = self.res[title]
+        if i < len(vals):
+            vals[i] = val
+            self.stddev[title][i] = stddev
+            self.multiplex[title][i] = multiplex
+        else:
+            vals.append(val)
+            self.stddev[title].append(stddev)
+            self.multiplex[title].append(multiplex)
+        rev = self.rev[title]
+        if i == len(rev):
+            rev.append(event)
+        elif rev[i] != event:
+            # this cpu diverges from the shared order, give it its own list
+            self.rev[title] = rev[:i] + [event]
+        self.fill[title] = i + 1
+
+    def empty(self):
+        return len(self.fill) == 0
+
+    # trim the arrays to what was filled in the current interval
+    def finish(self):
+        for title in self.res.keys():
+            n = self.fill[title]
+            if n == 0:
+                for d in (self.res, self.rev, self.valstats, self.stddev, self.multiplex):
+                    del d[title]
+            elif n < len(self.res[title]):
+                del self.res[title][n:]
+                del self.stddev[title][n:]
+                del self.multiplex[title][n:]
+
+    def reset(self):
+        self.fill.clear()
+
+def flush_interval(runner, store, out, env, interval, prev_interval):
+    if not store.empty():
+        set_interval(env, interval - prev_interval)
+        store.finish()
+        print_and_sum_keys(runner, store.res, store.rev, store.valstats,
+                           out, prev_interval, env)
+        store.reset()
+
+def store_result(store, title, event, val, stddev, multiplex):
+    # power/uncore events are only output once for every socket. duplicate them
+    # to all cpus in the socket to make the result lists match
+    # unless we use -A ??
+    # also -C xxx causes them to be duplicated too, unless single thread
+    if ((event.startswith("power") or event.startswith("uncore")) and
+            title != "" and (not (args.core and not args.single_thread))):
+        cpunum = int(title)
+        socket = cpu.cputosocket[cpunum]
+        for j in cpu.sockettocpus[socket]:
+            if not args.core or display_core(j, True):
+                store.add("%d" % (j), event, val, stddev, multiplex)
+    else:
+        store.add(title, event, val, stddev, multiplex)
+
+# read the rest of the perf output, so that perf can exit
+def drain(inf):
+    try:
+        while inf.readline():
+            pass
+    except exceptions.IOError:
+        pass
+
+def do_execute(runner, events, out, rest, store, env, phase=None):
+    if args.collector == "direct" and not args.__dict__['import']:
+        return do_execute_direct(runner, events, out, rest, store, env)
+    if args.__dict__['import'] and tl_statrecord.is_stat_record(args.__dict__['import']):
+        return do_execute_record(runner, events, out, store, env)
+    if args.__dict__['import'] and tl_archive.is_archive(args.__dict__['import']):
+        return do_execute_archive(runner, events, out, store, env)
     evstr = ",".join(map(event_group, events))
     account = defaultdict(Stat)
     inf, prun = setup_perf(evstr, rest)
     prev_interval = 0.0
+    if phase:
+        phase.prun = prun
+        if phase.finished:
+            prun.stop()
+        prev_interval = phase.start
     interval = None
     start = time.time()
-    init_res = copy.deepcopy(res)
+    init_fill = Counter(store.fill)
+    ss = runner.selfstats
     while True:
         try:
             l = inf.readline()
             if not l:
                 break
+            if ss:
+                t = time.time()
+                ss.lines += 1
             if args.perf_output:
                 args.perf_output.write(l)
             l = l.strip()
@@ -854,14 +1476,21 @@ def do_execute(runner, events, out, rest, res, rev, valstats, env):
             m = re.match(r"\s*([0-9.]+);(.*)", l)
             if m:
                 interval = float(m.group(1))
+                if phase:
+                    interval += phase.start
                 l = m.group(2)
                 if interval != prev_interval:
-                    if res:
-                        set_interval(env, interval - prev_interval)
-			print_and_sum_keys(runner, res, rev, valstats, out, prev_interval, env)
-                        res = defaultdict(list)
-                        rev = defaultdict(list)
-                        valstats = defaultdict(list)
+                    if ss:
+                        ss.add("parse", t)
+                    flush_interval(runner, store, out, env, interval, prev_interval)
+                    if ss:
+                        t = time.time()
+                    # drop the partial interval when the phase is over
+                    if phase and phase.next_interval():
+                        phase.stopped = True
+                        prun.stop()
+                        drain(inf)
+                        break
                     prev_interval = interval
 
         n = l.split(";")
@@ -913,41 +1542,313 @@ def do_execute(runner, events, out, rest, res, rev, valstats, env):
             multiplex = float(n[off + 1].replace(",", "."))
             off += 2
 
-        st = ValStat(stddev=stddev, multiplex=multiplex)
-
         account[event].total += 1
-
-        # power/uncore events are only output once for every socket. duplicate them
-        # to all cpus in the socket to make the result lists match
-        # unless we use -A ??
-        # also -C xxx causes them to be duplicated too, unless single thread
-        if ((event.startswith("power") or event.startswith("uncore")) and
-                title != "" and (not (args.core and not args.single_thread))):
-            cpunum = int(title)
-            socket = cpu.cputosocket[cpunum]
-            for j in cpu.sockettocpus[socket]:
-                if not args.core or display_core(j, True):
-                    res["%d" % (j)].append(val)
-                    rev["%d" % (j)].append(event)
-                    valstats["%d" % (j)].append(st)
-        else:
-            res[title].append(val)
-            rev[title].append(event)
-            valstats[title].append(st)
+        store_result(store, title, event, val, stddev, multiplex)
 
         if args.raw or args.valcsv:
             dump_raw(interval if interval_mode else "",
                      title,
                      event,
                      val,
-                     len(res[title]) - len(init_res[title]) - 1,
+                     store.fill[title] - init_fill[title] - 1,
                      events, stddev, multiplex)
+        if ss:
+            ss.add("parse", t)
     inf.close()
+    store.finish()
     if 'interval-s' not in env:
             set_interval(env, time.time() - start)
     ret = prun.wait()
+    if phase:
+        phase.end = prev_interval
+    print_account(account)
+    return ret, interval
+
+# perf arguments understood by the direct collector
+def direct_args(rest):
+    system, percpu, cpus, pid = False, False, None, None
+    i = 0
+    while i < len(rest):
+        a = rest[i]
+        if a in ("-a", "--all-cpus"):
+            system = True
+        elif a in ("-A", "--no-aggr"):
+            percpu = True
+        elif a in ("-C", "--cpu") and i + 1 < len(rest):
+            cpus = tl_perfopen.parse_cpus(rest[i + 1])
+            i += 1
+        elif a in ("-p", "--pid") and i + 1 < len(rest):
+            pid = int(rest[i + 1])
+            i += 1
+        elif a.startswith("-"):
+            sys.exit("perf argument %s not supported with --collector direct" % (a,))
+        else:
+            break
+        i += 1
+    return system or cpus is not None, percpu, cpus, pid, rest[i:]
+
+# fork the workload, but let it only exec when the counters are set up
+def fork_workload(cmd):
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(w)
+        os.read(r, 1)
+        try:
+            os.execvp(cmd[0], cmd)
+        except OSError as e:
+            print >>sys.stderr, "Cannot run %s: %s" % (cmd[0], e.strerror)
+        os._exit(127)
+    os.close(r)
+    return pid, w
+
+# count the events with perf_event_open instead of perf
+def do_execute_direct(runner, events, out, rest, store, env):
+    system, percpu, cpus, pid, cmd = direct_args(rest)
+    account = defaultdict(Stat)
+    groups = [(add_filter(g), is_group(g)) for g in events]
+    child, wakeup = fork_workload(cmd) if cmd else (None, None)
+    try:
+        if system:
+            c = tl_perfopen.Collector(groups, cpus=cpus or cpu.allcpus,
+                                      aggregate=not percpu)
+        elif pid:
+            c = tl_perfopen.Collector(groups, pids=map(int, os.listdir("/proc/%d/task" % pid)))
+        elif child:
+            c = tl_perfopen.Collector(groups, pids=[child], enable_on_exec=True)
+        else:
+            sys.exit("Need a workload, -a or -p with --collector direct")
+    except (tl_perfopen.EventError, OSError) as e:
+        if child:
+            os.kill(child, signal.SIGKILL)
+        sys.exit("Cannot open events: %s" % (e,))
+    if child:
+        os.write(wakeup, "x")
+        os.close(wakeup)
+    init_fill = Counter(store.fill)
+    start = time.time()
+    prev_interval = 0.0
+    interval = None
+    status = None
+    ticks = 0
+    done = False
+    while not done:
+        try:
+            if interval_mode:
+                ticks += 1
+                deadline = start + ticks * interval_mode / 1000.
+                while not done and time.time() < deadline:
+                    time.sleep(max(min(deadline - time.time(), 0.01), 0))
+                    if child:
+                        p, status = os.waitpid(child, os.WNOHANG)
+                        done = p != 0
+            elif child:
+                _, status = os.waitpid(child, 0)
+                done = True
+            else:
+                signal.pause()
+        except KeyboardInterrupt:
+            done = True
+        now = time.time() - start
+        if interval_mode:
+            interval = now
+        for c_cpu, event, val, multiplex in c.read():
+            title = "%d" % c_cpu if c_cpu is not None else ""
+            event = event.replace("/k", "/").replace("/u", "/")
+            account[event].total += 1
+            if val is None:
+                account[event].errors["not counted"] += 1
+                val = 0
+            store_result(store, title, event, val, 0., multiplex)
+            if args.raw or args.valcsv:
+                dump_raw(interval if interval_mode else "",
+                         title,
+                         event,
+                         val,
+                         store.fill[title] - init_fill[title] - 1,
+                         events, 0., multiplex)
+        # the counts cover the time since the last read
+        set_interval(env, now - prev_interval)
+        # the last interval is printed by execute
+        if interval_mode and not done:
+            store.finish()
+            print_and_sum_keys(runner, store.res, store.rev, store.valstats,
+                               out, interval, env)
+            store.reset()
+        prev_interval = now
+    c.close()
+    store.finish()
+    ret = 0
+    if child:
+        if status is None:
+            _, status = os.waitpid(child, 0)
+        ret = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
     print_account(account)
-    return ret, res, rev, interval, valstats
+    return ret, interval
+
+def record_title(rec, event, cpuidx):
+    mode = rec.aggr_mode
+    if mode not in (tl_statrecord.AGGR_NONE, tl_statrecord.AGGR_SOCKET,
+                    tl_statrecord.AGGR_CORE):
+        return ""
+    if event.startswith("power") or event.startswith("uncore"):
+        # these count on the first cpu of every socket
+        c = cpu.sockettocpus[sorted(cpu.sockettocpus.keys())[cpuidx]][0]
+    elif cpuidx < len(rec.cpus):
+        c = rec.cpus[cpuidx]
+    else:
+        c = cpuidx
+    if mode == tl_statrecord.AGGR_SOCKET:
+        return "S%d" % cpu.cputosocket[c]
+    if mode == tl_statrecord.AGGR_CORE:
+        return "S%d-C%d" % cpu.cputocore[c]
+    return "%d" % c
+
+# sum the counts of a round for every title and event in record order
+def record_counts(rec, counts):
+    totals = dict()
+    order = []
+    for evsel, cpuidx, _, val, ena, run in counts:
+        event = rec.names[evsel].replace("/k", "/").replace("/u", "/")
+        key = (record_title(rec, event, cpuidx), evsel)
+        if key not in totals:
+            totals[key] = [event, 0, 0, 0]
+            order.append(key)
+        t = totals[key]
+        t[1] += val
+        t[2] += ena
+        t[3] += run
+    return [key + tuple(totals[key]) for key in order]
+
+# import the counts of a perf stat record file
+def do_execute_record(runner, events, out, store, env):
+    fn = args.__dict__['import']
+    evl = [e.replace("/k", "/").replace("/u", "/") for e in flatten(events)]
+    account = defaultdict(Stat)
+    init_fill = Counter(store.fill)
+    prev_interval = 0.0
+    interval = None
+    cols = None
+    try:
+        rec = tl_statrecord.StatRecord(fn)
+        for rtype, t, counts in rec.rounds():
+            if rtype == tl_statrecord.ROUND_INTERVAL:
+                if not interval_mode:
+                    sys.exit("%s has interval data. Use -I %d" % (fn, rec.interval))
+                interval = t / 1e9
+                flush_interval(runner, store, out, env, interval, prev_interval)
+                prev_interval = interval
+            elif interval is not None:
+                # totals at the end of an interval recording
+                continue
+            elif t is not None:
+                set_interval(env, t / 1e9)
+            if cols is None:
+                # the event names are known with the first counts
+                cols = archive_columns([e.replace("/k", "/").replace("/u", "/")
+                                        for e in rec.names], evl)
+                missing = sorted(set([event_rmap(e) for e, c in zip(evl, cols) if c is None]))
+                if missing:
+                    sys.exit("%s: events missing in record: %s\n"
+                             "Record with the same toplev options." % (fn, " ".join(missing)))
+            byevent = defaultdict(list)
+            for title, evsel, event, val, ena, run in record_counts(rec, counts):
+                byevent[evsel].append((title, event, val, ena, run))
+            # in the order of the result maps
+            for c in cols:
+                for title, event, val, ena, run in byevent[c]:
+                    account[event].total += 1
+                    if run == 0:
+                        account[event].errors["not counted"] += 1
+                        val, multiplex = 0, 0.
+                    else:
+                        val, multiplex = val * (float(ena) / run), 100.0 * run / ena
+                    store_result(store, title, event, val, 0., multiplex)
+                    if args.raw or args.valcsv:
+                        dump_raw(interval if interval_mode else "",
+                                 title,
+                                 event,
+                                 val,
+                                 store.fill[title] - init_fill[title] - 1,
+                                 events, 0., multiplex)
+        rec.close()
+    except (IOError, tl_statrecord.FormatError) as e:
+        sys.exit("Cannot read %s: %s" % (fn, e))
+    store.finish()
+    print_account(account)
+    return 0, interval
+
+# map the events to columns of an archived title.
+# Match by perf name first, then by event name, so that a different
+# level or node subset can be computed from the same archive.
+def archive_columns(names, evl):
+    cols = defaultdict(list)
+    rcols = defaultdict(list)
+    for j, e in enumerate(names):
+        cols[e].append(j)
+        rcols[event_rmap(e)].append(j)
+    seen = Counter()
+    m = []
+    for e in evl:
+        c = cols.get(e) or rcols.get(event_rmap(e))
+        if c:
+            m.append(c[min(seen[e], len(c) - 1)])
+        else:
+            m.append(None)
+        seen[e] += 1
+    return m
+
+# recompute from a --raw-archive file
+def do_execute_archive(runner, events, out, store, env):
+    fn = args.__dict__['import']
+    evl = [e.replace("/k", "/").replace("/u", "/") for e in flatten(events)]
+    account = defaultdict(Stat)
+    prev_interval = 0.0
+    interval = None
+    seg = None
+    try:
+        reader = tl_archive.ArchiveReader(fn)
+        for s, ch in reader.chunks():
+            if s is not seg:
+                seg = s
+                if seg.info.get("cpu") != cpu.cpu:
+                    print >>sys.stderr, "Warning: %s recorded on %s, not %s" % (
+                            fn, seg.info.get("cpu"), cpu.cpu)
+                if seg.info.get("interval") and not interval_mode:
+                    sys.exit("%s has interval data. Use -I %d" % (fn, seg.info["interval"]))
+                cols = dict([(t, archive_columns(seg.events[t], evl)) for t in seg.titles])
+            for i in range(ch.n):
+                ts = ch.timestamps[i]
+                if interval_mode:
+                    interval = ts
+                    flush_interval(runner, store, out, env, interval, prev_interval)
+                    prev_interval = interval
+                else:
+                    # a previous measurement, like with --sample-repeat
+                    if not store.empty():
+                        store.finish()
+                        print_and_sum_keys(runner, store.res, store.rev, store.valstats,
+                                           out, None, env)
+                        store.reset()
+                    set_interval(env, ts)
+                base = i * seg.width
+                for t in seg.titles:
+                    names = seg.events[t]
+                    off = base + seg.offset[t]
+                    for e, c in zip(evl, cols[t]):
+                        account[e].total += 1
+                        if c is None:
+                            account[e].errors["not in archive"] += 1
+                            store.add(t, e, 0., 0., 0.)
+                        else:
+                            store.add(t, names[c], ch.vals[off + c],
+                                      ch.stddev[off + c], ch.multiplex[off + c])
+        reader.close()
+    except (IOError, ValueError, zlib.error, tl_archive.FormatError) as e:
+        sys.exit("Cannot read %s: %s" % (fn, e))
+    store.finish()
+    print_account(account)
+    return 0, interval
 
 def ev_append(ev, level, obj):
     if isinstance(ev, types.LambdaType):
@@ -978,7 +1879,7 @@ fixes = dict(zip(event_fixes.values(), event_fixes.keys()))
 
 def do_event_rmap(e):
     n = canon_event(emap.getperf(e))
-    if emap.getevent(n):
+    if emap.resolve_event(n):
         return n
     if n.upper() in fixes:
         n = fixes[n.upper()].lower()
@@ -995,23 +1896,30 @@ def event_rmap(e):
     rmap_cache[e] = n
     return n
 
-def map_fields(obj, fields):
-    def map_field(name):
-        if has(obj, name):
-            return obj.name
-        return None
-    return map(map_field, fields)
-
 # compare events to handle name aliases
 def compare_event(aname, bname):
-    a = emap.getevent(aname)
-    if a is None:
+    a, b = emap.resolve([aname, bname])
+    if a is None or b is None:
         return False
-    b = emap.getevent(bname)
-    if b is None:
-        return False
-    fields = ('val','event','cmask','edge','inv')
-    return map_fields(a, fields) == map_fields(b, fields)
+    return a.perf == b.perf
+
+# sanity check that the result index maps to the expected event
+def check_event(rev, index, ev):
+    rmap_ev = event_rmap(rev[index]).lower()
+    ev = ev.lower()
+    assert (rmap_ev == canon_event(ev).replace("/k", "/") or
+            compare_event(rmap_ev, ev) or
+            (ev in event_fixes and canon_event(event_fixes[ev]) == rmap_ev) or
+            rmap_ev == "dummy")
+
+def thread_res(res, index, cpuoff):
+    if isinstance(res[index], types.TupleType):
+        try:
+            return res[index][cpuoff]
+        except IndexError:
+            print >>sys.stderr, "warning: Partial CPU thread data from perf"
+            return 0
+    return res[index]
 
 def lookup_res(res, rev, ev, obj, env, level, referenced, cpuoff, st):
     if ev in env:
@@ -1035,22 +1943,12 @@ def lookup_res(res, rev, ev, obj, env, level, referenced, cpuoff, st):
     referenced.add(index)
     #print (ev, level, obj.name), "->", index
     if not args.fast:
-        rmap_ev = event_rmap(rev[index]).lower()
-        ev = ev.lower()
-        assert (rmap_ev == canon_event(ev).replace("/k", "/") or
-                compare_event(rmap_ev, ev) or
-                (ev in event_fixes and canon_event(event_fixes[ev]) == rmap_ev) or
-                rmap_ev == "dummy")
+        check_event(rev, index, ev)
 
     if isinstance(res[index], types.TupleType):
         if cpuoff == -1:
             return sum(res[index])
-        else:
-            try:
-                return res[index][cpuoff]
-            except IndexError:
-                print >>sys.stderr, "warning: Partial CPU thread data from perf"
-                return 0
+        return thread_res(res, index, cpuoff)
     return res[index]
 
 def add_key(k, x, y):
@@ -1202,6 +2100,34 @@ def _find_bn(bn, level):
         return siblings[0]
     return n
 
+# Tarjan's algorithm. Return the number of the strongly connected
+# component of every key of the graph edges (key -> list of keys).
+def strong_components(keys, edges):
+    index = dict()
+    low = dict()
+    comp = dict()
+    stack = []
+    def visit(k):
+        index[k] = low[k] = len(index)
+        stack.append(k)
+        for v in edges[k]:
+            if v not in index:
+                visit(v)
+                low[k] = min(low[k], low[v])
+            elif v not in comp:
+                low[k] = min(low[k], index[v])
+        if low[k] == index[k]:
+            n = len(set(comp.values()))
+            while True:
+                v = stack.pop()
+                comp[v] = n
+                if v == k:
+                    break
+    for k in keys:
+        if k not in index:
+            visit(k)
+    return comp
+
 def find_bn(olist, match):
     bn = [o for o in olist if match(o) and o.thresh and not o.metric]
     if len(bn) == 0:
@@ -1253,27 +2179,42 @@ def node_unit(obj):
              (" below" if not obj.thresh else ""))
 
 class Summary:
-    """Accumulate counts for summary."""
-    def __init__(self):
-	self.res = defaultdict(list)
-	self.rev = defaultdict(list)
+    """Accumulate counts for summary.
+       Keeps fixed size running statistics for every cpu and event,
+       and optionally quantile sketches of the node values."""
+    def __init__(self, percentiles=False):
+	self.stats = dict()
+	self.rev = dict()
 	self.env = Counter()
-	self.valstats = defaultdict(list)
+	self.sketches = defaultdict(dict) if percentiles else None
+	self.intervals = 0
 
     def add(self, res, rev, valstats, env):
-	# assume perf always outputs the same
-	if self.rev:
-	    assert rev == self.rev
 	for j in res.keys():
-            if len(self.res[j]) == 0:
-                self.res[j] = res[j]
-            else:
-	        self.res[j] = [a+b for a, b in zip(self.res[j], res[j])]
-	self.rev = rev
-	for j in valstats.keys():
-	    self.valstats[j] = self.valstats[j] + valstats[j]
+	    if j not in self.stats:
+		self.stats[j] = RunningStats(len(res[j]))
+		self.rev[j] = list(rev[j])
+	    # assume perf always outputs the same
+	    assert len(rev[j]) == len(self.rev[j])
+	    self.stats[j].add(res[j], valstats[j])
 	for j in env.keys():
 	    self.env[j] += env[j]
+	self.intervals += 1
+
+    def add_nodes(self, title, olist, match):
+	if self.sketches is None:
+	    return
+	sk = self.sketches[title]
+	for o in olist:
+	    if match(o) and 'val' in o.__dict__ and isinstance(o.val, (int, long, float)) and o.val == o.val:
+		if o.name not in sk:
+		    sk[o.name] = QuantileSketch()
+		sk[o.name].add(o.val)
+
+    def results(self):
+	res = dict([(j, s.sum) for j, s in self.stats.items()])
+	valstats = dict([(j, s.valstats()) for j, s in self.stats.items()])
+	return res, self.rev, valstats
 
 def parse_metric_group(l, mg):
     if l is None:
@@ -1308,13 +2249,18 @@ class Runner:
         self.stat = ComputeStat(args.quiet)
         # always needs to be filtered by olist:
         self.metricgroups = defaultdict(list)
+        self.compiled = dict()
+        self.archive = None
+        # bottleneck counts for --drilldown
+        self.bottlenecks = Counter() if args.drilldown else None
+        self.selfstats = None
         if args.valcsv:
             self.valcsv = csv.writer(args.valcsv)
             self.valcsv.writerow(("Timestamp", "CPU" ,"Group", "Event", "Value",
                                   "Perf-event", "Index", "STDEV", "MULTI"))
 	self.summary = None
 	if args.summary:
-	    self.summary = Summary()
+	    self.summary = Summary(args.summary_percentiles)
 
     def do_run(self, obj):
         obj.res = None
@@ -1352,11 +2298,6 @@ class Runner:
         if d:
             sys.exit("Unknown node(s) in --nodes: " + " ".join(d))
 
-    def reset_thresh(self):
-        for obj in self.olist:
-            if not obj.metric:
-                obj.thresh = False
-
     def run(self, obj):
         obj.thresh = False
         obj.metric = False
@@ -1509,14 +2450,176 @@ class Runner:
         if curobj:
             self.add(curobj, curev, curlev)
         if print_group:
-            num_groups = len([x for x in self.evgroups if needed_counters(x) <= cpu.counters])
-            print "%d groups, %d non-groups with %d events total (%d unique) for %d objects, missed %d merges" % (
-                num_groups,
-                len(self.evgroups) - num_groups,
-                len(self.evnum),
-                len(set(self.evnum)),
-                len(self.olist),
-                self.missed)
+            self.print_group_summary()
+
+    def print_group_summary(self):
+        num_groups = len([x for x in self.evgroups if needed_counters(x) <= cpu.counters])
+        print "%d groups, %d non-groups with %d events total (%d unique) for %d objects, missed %d merges" % (
+            num_groups,
+            len(self.evgroups) - num_groups,
+            len(self.evnum),
+            len(set(self.evnum)),
+            len(self.olist),
+            self.missed)
+
+    # split events of objects that do not fit into a group
+    # into pieces that do, like split_groups
+    def pack_items(self, objl, evlev):
+        if needed_counters(raw_events(get_names(evlev))) <= cpu.counters:
+            return [(objl, evlev)]
+        levels = set(get_levels(evlev))
+        if len(levels) == 1:
+            l = []
+            while evlev:
+                n = max(grab_group(map(raw_event, get_names(evlev))), 1)
+                l.append((objl, evlev[:n]))
+                evlev = evlev[n:]
+            return l
+        return sum([self.pack_items(objl, filter(lambda x: x[1] == lev, evlev))
+                    for lev in levels], [])
+
+    # bin packing of the objects into groups
+    # all events of an object stay in one group unless they don't fit
+    # objects share events when their groups are merged
+    def schedule_pack(self):
+        items = []
+        for obj in sorted(self.olist, cmp=cmp_obj):
+            items += self.pack_items([obj], obj.evlevels)
+        # biggest first, then put each into the group where it adds
+        # the fewest counters
+        items = [(needed_counters(raw_events(get_names(evlev))), objl, evlev)
+                 for objl, evlev in items]
+        items.sort(key=lambda x: -x[0])
+        bins = []
+        for nc, objl, evlev in items:
+            evnum = raw_events(get_names(evlev))
+            evset = set(evnum)
+            outgroup = not (evset - outgroup_events)
+            best = None
+            for b in bins:
+                if b[0] != outgroup:
+                    continue
+                # don't merge outgroup events into groups, but share them
+                if outgroup and not evset <= b[1]:
+                    continue
+                n = needed_counters(b[1] | evset)
+                if n > cpu.counters:
+                    continue
+                cost = (n - b[2], -n)
+                if best is None or cost < best[0]:
+                    best = (cost, b, n)
+            if best is None:
+                bins.append([outgroup, evset, nc, [], [], []])
+                b = bins[-1]
+            else:
+                b = best[1]
+                b[1] |= evset
+                b[2] = best[2]
+            for e in evnum:
+                if e not in b[3]:
+                    b[3].append(e)
+            b[4] += objl
+            b[5] += evlev
+        for _, _, _, evnum, objl, evlev in bins:
+            base = len(self.evnum)
+            if args.debug:
+                print "pack", evnum, base, map(event_rmap, evnum)
+            update_res_map(evnum, objl, base)
+            self.evnum += evnum
+            self.evgroups.append(evnum)
+            self.evbases.append(base)
+            if print_group:
+                print_header(objl, get_names(evlev))
+        if print_group:
+            self.print_group_summary()
+
+    # everything the schedule depends on
+    def schedule_key(self):
+        key = {
+            "cache": SCHEDULE_CACHE_VERSION,
+            "scheduler": args.scheduler,
+            "model": version,
+            "cpu": cpu.cpu,
+            "level": args.level,
+            "nodes": args.nodes,
+            "metrics": args.metrics,
+            "metric_group": args.metric_group,
+            "counters": cpu.counters,
+            "kernel": kernel_version,
+            "emap": file_stat(emap.files),
+            "objects": [(obj.name, obj.evlevels, obj.evnum) for obj in self.olist],
+            "outgroup": sorted(outgroup_events),
+            "limited": sorted(limited_counters.items()),
+        }
+        return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def load_schedule(self, fn):
+        try:
+            with open(fn, "r") as f:
+                d = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if len(d["res_map"]) != len(self.olist):
+            return False
+        self.evgroups = [map(str, x) for x in d["evgroups"]]
+        self.evbases = d["evbases"]
+        self.evnum = map(str, d["evnum"])
+        self.missed = d["missed"]
+        for obj, m in zip(self.olist, d["res_map"]):
+            obj.res_map = dict([((str(ev), level, obj.name), index) for ev, level, index in m])
+        return True
+
+    def save_schedule(self, fn):
+        d = {
+            "evgroups": self.evgroups,
+            "evbases": self.evbases,
+            "evnum": self.evnum,
+            "missed": self.missed,
+            "res_map": [[(k[0], k[1], v) for k, v in obj.res_map.items()]
+                        for obj in self.olist],
+        }
+        tmp = "%s.%d" % (fn, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                json.dump(d, f)
+            os.rename(tmp, fn)
+        except (IOError, OSError):
+            pass
+
+    def do_schedule(self):
+        if args.scheduler == "pack":
+            self.schedule_pack()
+        else:
+            self.schedule()
+
+    # reuse the schedule of an earlier run with the same parameters
+    def cached_schedule(self):
+        if args.no_schedule_cache or print_group or args.debug:
+            self.do_schedule()
+            return
+        try:
+            fn = "%s/toplev-schedule-%s.json" % (event_download.getdir(), self.schedule_key())
+        except Exception:
+            self.do_schedule()
+            return
+        if self.load_schedule(fn):
+            return
+        self.do_schedule()
+        self.save_schedule(fn)
+
+    # measure only a subset of the nodes from now on
+    def select_nodes(self, olist):
+        self.olist = olist
+        self.evnum = []
+        self.evgroups = []
+        self.evbases = []
+        self.missed = 0
+        self.compiled = dict()
+        self.__dict__.pop('guards', None)
+        self.__dict__.pop('smt_levels', None)
+        for obj in olist:
+            obj.res_map = dict()
+        self.cached_schedule()
 
     def propagate_siblings(self):
         for obj in self.olist:
@@ -1527,37 +2630,279 @@ class Runner:
                 else:
                     obj.sibling.thresh = True
 
+    # In SMT mode the siblings propagate as after a thread pass and a
+    # core pass, each followed by propagate_siblings, repeated three
+    # times: a pass sets the computed thresh of its nodes again, but
+    # keeps the propagated thresh of the other kind.
+    def propagate_smt_siblings(self):
+        computed = [(o, o.thresh) for o in self.olist if not package_node(o)]
+        for _ in range(3):
+            for kind in (thread_node, core_node):
+                for o, thresh in computed:
+                    if kind(o):
+                        o.thresh = thresh
+                self.propagate_siblings()
+
+    # Only compute the children of nodes above threshold.
+    # A node is gated on its parent when its thresh can only be true
+    # when the parent's thresh is, and no other node uses it. Skipped
+    # nodes get the same thresh as when computed, so the printed output
+    # doesn't change. -v prints everything, so computes everything too.
+    def lazy_guards(self):
+        if 'guards' not in self.__dict__:
+            self.guards = None
+            if not (print_all or args.no_lazy or args.summary_percentiles):
+                # siblings can set the thresh of a node below threshold,
+                # and nodes using other nodes recompute them with their
+                # own counts, so all these have to run
+                referenced = set()
+                for obj in self.olist:
+                    for k, v in obj.__dict__.items():
+                        if k == 'sibling' and isinstance(v, (list, tuple)):
+                            referenced |= set(map(id, v))
+                        elif k == 'sibling' and v:
+                            referenced.add(id(v))
+                        elif k != 'parent' and hasattr(v, 'compute') and hasattr(v, 'thresh'):
+                            referenced.add(id(v))
+                            referenced.add(id(obj))
+                cand = lambda obj: (getattr(obj, 'parent', None) and not obj.metric and
+                                    id(obj) not in referenced)
+                # trace them to check that their thresh is always false
+                # when the parent's is
+                c = tl_compile.Compiler(self.olist, cand, cpu.threads, nonperf_events)
+                self.guards = [obj.parent if cand(obj) and c.gated(i, obj.parent) else None
+                               for i, obj in enumerate(self.olist)]
+        return self.guards
+
+    def skip_obj(self, obj, stat):
+        obj.val = float('nan')
+        obj.thresh = False
+        obj.valstat = None
+        if stat:
+            stat.referenced.update(obj.res_map.itervalues())
+
+    def compute_reference(self, res, rev, valstats, env, match, stat):
+        guards = self.lazy_guards()
+        for i, obj in enumerate(self.olist):
+            obj.errcount = 0
+            if match(obj):
+                if guards and guards[i] is not None and not guards[i].thresh:
+                    self.skip_obj(obj, stat)
+                else:
+                    self.compute_obj(obj, res, rev, valstats, env, stat)
+
+    def compute_obj(self, obj, res, rev, valstats, env, stat):
+        ref = set()
+        obj.compute(lambda e, level:
+                        lookup_res(res, rev, e, obj, env, level, ref, -1, valstats))
+        if stat:
+            stat.referenced |= ref
+        self.finish_obj(obj, combine_ref(valstats, ref), env, stat)
+
+    def finish_obj(self, obj, valstat, env, stat):
+        obj.valstat = valstat
+        if not obj.res_map and not all([x in env for x in obj.evnum]):
+            print >>sys.stderr, "%s not measured" % (obj.__class__.__name__,)
+        if not obj.metric and not check_ratio(obj.val):
+            obj.thresh = False
+            if stat:
+                stat.mismeasured.add(obj.name)
+        if stat and has(obj, 'errcount') and obj.errcount > 0:
+            if obj.name not in stat.errors:
+                stat.errcount += obj.errcount
+            stat.errors.add(obj.name)
+
+    def get_compiled(self, match, per_thread):
+        key = (match, per_thread)
+        if key not in self.compiled:
+            c = tl_compile.Compiler(self.olist, match, cpu.threads, nonperf_events,
+                                    self.lazy_guards())
+            if args.debug:
+                print "compiled %d nodes, %d use reference path for %s" % (
+                        c.compiled, c.fallback, match.__name__)
+            self.compiled[key] = (c.function(), c.leaves, dict())
+        return self.compiled[key]
+
+    def compute_compiled(self, res, rev, valstats, env, match, stat):
+        per_thread = isinstance(res[0], types.TupleType)
+        f, leaves, checked = self.get_compiled(match, per_thread)
+        if not args.fast and id(rev) not in checked:
+            for index, ev in leaves:
+                check_event(rev, index, ev)
+            checked[id(rev)] = rev
+        olist = self.olist
+        V = [sum(x) for x in res] if per_thread else res
+        # many nodes reference the same events
+        vs_cache = dict()
+        def finish(i, ref):
+            if ref not in vs_cache:
+                vs_cache[ref] = combine_ref(valstats, ref)
+                if stat:
+                    stat.referenced |= ref
+            self.finish_obj(olist[i], vs_cache[ref], env, stat)
+        mux = []
+        def get_mux():
+            if not mux:
+                mux.append(combine_valstat(valstats).multiplex)
+            return mux[0]
+        f(V,
+          lambda index, off: thread_res(res, index, off),
+          env,
+          get_mux,
+          lambda i: self.compute_obj(olist[i], res, rev, valstats, env, stat),
+          finish,
+          lambda i: self.skip_obj(olist[i], stat))
+
+    def compute_nodes(self, res, rev, valstats, env, match, stat):
+        if args.no_compile:
+            self.compute_reference(res, rev, valstats, env, match, stat)
+        elif args.check_compile:
+            self.check_compiled(res, rev, valstats, env, match, stat)
+        else:
+            self.compute_compiled(res, rev, valstats, env, match, stat)
+
     def compute(self, res, rev, valstats, env, match, stat):
         if len(res) == 0:
             print "Nothing measured?"
             return
 
         # step 1: compute
-        for obj in self.olist:
-            obj.errcount = 0
-
-            if not match(obj):
-                continue
-            ref = set()
-            obj.compute(lambda e, level:
-                            lookup_res(res, rev, e, obj, env, level, ref, -1, valstats))
-            if stat:
-                stat.referenced |= ref
-            obj.valstat = combine_valstat([valstats[i] for i in ref])
-            if not obj.res_map and not all([x in env for x in obj.evnum]):
-                print >>sys.stderr, "%s not measured" % (obj.__class__.__name__,)
-            if not obj.metric and not check_ratio(obj.val):
-                obj.thresh = False
-                if stat:
-                    stat.mismeasured.add(obj.name)
-            if stat and has(obj, 'errcount') and obj.errcount > 0:
-                if obj.name not in stat.errors:
-                    stat.errcount += obj.errcount
-                stat.errors.add(obj.name)
+        self.compute_nodes(res, rev, valstats, env, match, stat)
 
         # step 2: propagate siblings
         self.propagate_siblings()
 
+    # In SMT mode thread nodes use core nodes (like their parent) and
+    # the other way round. Nodes also overwrite the values of the nodes
+    # whose compute methods they call. Split them into levels, so that
+    # a node only uses nodes of the other kind, or later nodes of its
+    # kind, from lower levels. A node comes after the nodes it uses,
+    # and after the nodes writing the values it uses or writes before
+    # it in a thread pass followed by a core pass.
+    # Nodes in dependency cycles are computed twice: first only after
+    # the nodes before them in the passes, then after all nodes they
+    # use, with the values of the first round for the later nodes of
+    # the cycle.
+    # Return a (thread match, core match, nodes written by the core
+    # nodes) tuple for every level. A match is None when the level
+    # has no nodes of that kind.
+    def smt_matches(self):
+        if 'smt_levels' not in self.__dict__:
+            nodes = dict([(id(o), o) for o in self.olist if not package_node(o)])
+            index = dict([(id(o), i) for i, o in enumerate(self.olist)])
+            order = dict([(k, (core_node(o), index[k])) for k, o in nodes.items()])
+            # the nodes each node uses and calls, from its traced computation
+            c = tl_compile.Compiler(self.olist, lambda obj: id(obj) in nodes,
+                                    cpu.threads, nonperf_events)
+            refs = dict()
+            for i, o in enumerate(self.olist):
+                if id(o) in nodes:
+                    refs[id(o)] = c.uses(i) or ([v for k, v in o.__dict__.items()
+                                                 if k != 'sibling'], [])
+            writers = defaultdict(list)
+            for o in self.olist:
+                if id(o) in nodes:
+                    for v in [o] + refs[id(o)][1]:
+                        writers[id(v)].append(o)
+            def deps(obj):
+                reads, calls = refs[id(obj)]
+                return set([id(v) for v in reads if id(v) in nodes] +
+                           [id(w) for v in reads + [obj] + calls for w in writers.get(id(v), [])
+                            if order[id(w)] < order[id(obj)]]) - set([id(obj)])
+            keys = [id(o) for o in self.olist if id(o) in nodes]
+            dep = dict([(k, deps(nodes[k])) for k in keys])
+            comp = strong_components(keys, dep)
+            size = Counter(comp.values())
+            def after(v, k):
+                return core_node(nodes[v]) != core_node(nodes[k]) or index[v] > index[k]
+            first = dict()
+            level = dict()
+            def get_first(k):
+                if k not in first:
+                    n = 0
+                    for v in dep[k]:
+                        if comp[v] != comp[k]:
+                            n = max(n, get_level(v) + after(v, k))
+                        elif order[v] < order[k]:
+                            n = max(n, get_first(v) + after(v, k))
+                    first[k] = n
+                return first[k]
+            def get_level(k):
+                if k not in level:
+                    n = 0
+                    if size[comp[k]] > 1:
+                        n = get_first(k) + 1
+                    for v in dep[k]:
+                        if comp[v] != comp[k] or order[v] < order[k]:
+                            n = max(n, get_level(v) + after(v, k))
+                        else:
+                            n = max(n, get_first(v) + after(v, k))
+                    level[k] = n
+                return level[k]
+            for k in keys:
+                get_level(k)
+            members = defaultdict(set)
+            for k in keys:
+                members[level[k]].add(k)
+                if k in first:
+                    members[first[k]].add(k)
+            def make_match(kind, n):
+                m = set([k for k in members[n] if kind(nodes[k])])
+                if not m:
+                    return None
+                f = lambda obj: id(obj) in m
+                f.__name__ = "%s%d" % (kind.__name__, n)
+                return f
+            def written(n):
+                w = set([id(v) for k in members[n] if core_node(nodes[k])
+                         for v in [nodes[k]] + refs[k][1]])
+                return [o for o in self.olist if id(o) in w]
+            self.smt_levels = [(make_match(thread_node, n), make_match(core_node, n), written(n))
+                               for n in range(max(level.values() + [0]) + 1)]
+        return self.smt_levels
+
+    def save_nodes(self, l):
+        return [(o, dict([(k, o.__dict__[k]) for k in ('val', 'thresh', 'valstat') if k in o.__dict__]))
+                for o in l]
+
+    def load_nodes(self, l):
+        for o, d in l:
+            o.__dict__.update(d)
+
+    def compute_keys(self, keys, res, rev, valstats, env, match, stat):
+        """Compute the nodes key by key before anything is printed. Return a result
+           matrix with a row of node values for each key, and the bottleneck."""
+        rows = []
+        for j in keys:
+            self.compute(res[j], rev[j], valstats[j], env, match, stat)
+            bn = find_bn(self.olist, match) if match != package_node else None
+            # only computed nodes have a valstat, power nodes get val from collect
+            rows.append(([(o.val, o.thresh, getattr(o, 'valstat', None))
+                          if match(o) and 'val' in o.__dict__ else o.thresh
+                          for o in self.olist], bn))
+        return rows
+
+    def load_row(self, row):
+        for o, v in zip(self.olist, row):
+            if isinstance(v, tuple):
+                o.val, o.thresh, o.valstat = v
+            else:
+                o.thresh = v
+
+    # compare compiled results against the reference path
+    # nodes can refer to values of other nodes from the last interval
+    def check_compiled(self, res, rev, valstats, env, match, stat):
+        old = [(obj, dict(obj.__dict__)) for obj in self.olist]
+        self.compute_reference(res, rev, valstats, env, match, None)
+        l = [(obj, obj.val, obj.thresh) for obj in self.olist if match(obj)]
+        for obj, d in old:
+            obj.__dict__ = d
+        self.compute_compiled(res, rev, valstats, env, match, stat)
+        for obj, val, thresh in l:
+            if not (val == obj.val or (val != val and obj.val != obj.val)) or thresh != obj.thresh:
+                print >>sys.stderr, "compiled %s differs: %s %s, reference %s %s" % (
+                        obj.name, obj.val, obj.thresh, val, thresh)
+
     def print_res(self, out, timestamp, title, match, bn):
         out.logf.flush()
 
@@ -1774,6 +3119,17 @@ if len(rest) == 0 and not args.__dict__['import']:
     p.print_help()
     sys.exit(0)
 
+# bump when the scheduler changes
+SCHEDULE_CACHE_VERSION = 1
+
+# identify files by name, modification time and size, like the event map cache
+def file_stat(files):
+    l = []
+    for fn in files:
+        st = os.stat(fn)
+        l.append((os.path.abspath(fn), st.st_mtime, st.st_size))
+    return l
+
 def setup_with_metrics(p, runner):
     old_metrics = args.metrics
     args.metrics = True
@@ -1854,27 +3210,71 @@ if args.repl:
     sys.exit(0)
 
 runner.collect()
-if csv_mode:
-    if args.columns:
-        out = tl_output.OutputColumnsCSV(args.output, csv_mode, args, version, cpu)
-    else:
-        out = tl_output.OutputCSV(args.output, csv_mode, args, version, cpu)
-elif args.columns:
-    out = tl_output.OutputColumns(args.output, args, version, cpu)
+def make_output(logf):
+    if csv_mode:
+        if args.columns:
+            return tl_output.OutputColumnsCSV(logf, csv_mode, args, version, cpu)
+        return tl_output.OutputCSV(logf, csv_mode, args, version, cpu)
+    elif args.columns:
+        return tl_output.OutputColumns(logf, args, version, cpu)
+    return tl_output.OutputHuman(logf, args, version, cpu)
+
+if args.daemon:
+    ring = tl_daemon.Ring(args.daemon_intervals)
+    out = tl_daemon.OutputRing(ring, args.output, version)
+    daemon = tl_daemon.QueryServer(args.daemon, ring, make_output)
+    daemon.start()
+elif args.prometheus:
+    aggregate = args.prometheus_aggregate
+    if aggregate == "auto":
+        aggregate = "cpu"
+        if len(cpu.cputocore) > args.prometheus_max_cpus:
+            aggregate = "core" if len(cpu.coreids) <= args.prometheus_max_cpus else "socket"
+    out = tl_prometheus.OutputPrometheus(args.output, version,
+            lambda title: tl_prometheus.title_labels(title, aggregate, cpu))
+    host, _, port = args.prometheus.rpartition(":")
+    tl_prometheus.ScrapeServer((host or "localhost", int(port)), out).start()
 else:
-    out = tl_output.OutputHuman(args.output, args, version, cpu)
-runner.schedule()
+    out = make_output(args.output)
+runner.cached_schedule()
+
+if args.raw_archive:
+    runner.archive = tl_archive.ArchiveWriter(args.raw_archive,
+            {"version": version, "cpu": cpu.cpu, "level": args.level,
+             "interval": interval_mode},
+            compress=args.archive_compress)
+
+if args.self_stats:
+    runner.selfstats = tl_selfstats.SelfStats(args.self_stats)
+    runner.compute_nodes = runner.selfstats.timed("compute", runner.compute_nodes)
+    runner.propagate_siblings = runner.selfstats.timed("compute", runner.propagate_siblings)
+    runner.print_res = runner.selfstats.timed("print", runner.print_res)
+    out.flush = runner.selfstats.timed("flush", out.flush)
 
 def measure_and_sample(count):
     try:
         if args.no_multiplex:
             ret = execute_no_multiplex(runner, out, rest)
+        elif args.drilldown:
+            ret = execute_phases(runner, out, rest, Drilldown(runner))
+        elif args.overhead_budget:
+            ret = execute_phases(runner, out, rest, Governor(runner, args.overhead_budget))
         else:
             ret = execute(runner, out, rest)
     except KeyboardInterrupt:
 	print_summary(runner, out)
+        if runner.archive:
+            runner.archive.close()
+        if runner.selfstats:
+            runner.selfstats.summary()
+        if args.daemon:
+            daemon.stop()
         sys.exit(1)
     print_summary(runner, out)
+    if runner.archive:
+        runner.archive.flush()
+    if runner.selfstats:
+        runner.selfstats.summary()
     runner.stat.compute_errors()
     if args.show_sample or args.run_sample:
         do_sample(runner.sample_obj, rest, count)
@@ -1888,4 +3288,6 @@ if args.sample_repeat:
 else:
     ret = measure_and_sample(None)
 
+if args.daemon:
+    daemon.stop()
 sys.exit(ret)